@@ -0,0 +1,135 @@
+# Before/after benchmark for the authentication middleware.
+#
+#   pip install -r bench/requirements.txt
+#   python bench/auth_middleware.py [--requests N] [--stream-mb N]
+#
+# "before" is the old @app.middleware("http") implementation (with the header
+# lookup fixed so both variants do the same work), "after" is util.AuthMiddleware.
+
+import argparse, asyncio, json, logging, os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "server"))
+os.environ.setdefault("RAW_CONFIG", json.dumps({}))
+
+import httpx
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.status import *
+
+from util.auth import AuthMiddleware
+
+API_KEYS = {
+    "key-" + str(i): {"name": "user" + str(i), "scope": ["/admin", "/podcasts", "/files"]}
+    for i in range(16)
+}
+API_KEYS["root"] = {"name": "root", "scope": ["/"]}
+CHUNK = b"\0" * 65536
+log = logging.getLogger("uvicorn.error")
+log.setLevel(logging.ERROR)
+
+
+def base_app() -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/files/small")
+    async def small():
+        return {"result": "success", "value": {"ok": True}}
+
+    @app.get("/files/stream")
+    async def stream(mb: int = 16):
+        async def body():
+            for _ in range(mb * 16):
+                yield CHUNK
+
+        return StreamingResponse(body(), media_type="application/octet-stream")
+
+    return app
+
+
+def before_app() -> FastAPI:
+    app = base_app()
+
+    @app.middleware("http")
+    async def authenticate(request: Request, call_next):
+        if not request.url.path.strip("/").startswith("redoc"):
+            if not "authorization" in request.headers.keys():
+                return JSONResponse(
+                    content={"result": "failure", "message": "Authorization header not included"},
+                    status_code=HTTP_401_UNAUTHORIZED,
+                )
+            if not request.headers["authorization"] in API_KEYS.keys():
+                log.warning(
+                    f"Got bad-auth request from {request.client.host} with key {request.headers['authorization']}"
+                )
+                return JSONResponse(
+                    content={"result": "failure", "message": "Incorrect API key"},
+                    status_code=HTTP_401_UNAUTHORIZED,
+                )
+            key = API_KEYS[request.headers["authorization"]]
+            if not any([request.url.path.startswith(p) for p in key["scope"]]):
+                return JSONResponse(
+                    content={"result": "failure", "message": "Do not have scope to access path"},
+                    status_code=HTTP_403_FORBIDDEN,
+                )
+            log.debug(
+                f"Got request to {request.url.path} from {key['name']} @ {request.client.host}"
+            )
+        return await call_next(request)
+
+    return app
+
+
+def after_app() -> FastAPI:
+    app = base_app()
+    app.add_middleware(AuthMiddleware, authenticated=True, api_keys=API_KEYS)
+    return app
+
+
+async def run(app: FastAPI, requests: int, stream_mb: int) -> dict:
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        headers = {"Authorization": "key-7"}
+        for _ in range(50):
+            await client.get("/files/small", headers=headers)
+
+        start = time.perf_counter()
+        for _ in range(requests):
+            r = await client.get("/files/small", headers=headers)
+            assert r.status_code == 200
+        small = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in range(requests):
+            r = await client.get("/podcasts/x", headers={"Authorization": "nope"})
+            assert r.status_code == 401
+        rejected = time.perf_counter() - start
+
+        start = time.perf_counter()
+        size = 0
+        async with client.stream("GET", "/files/stream", params={"mb": stream_mb}, headers=headers) as r:
+            async for chunk in r.aiter_raw():
+                size += len(chunk)
+        streamed = time.perf_counter() - start
+
+    return {
+        "small_req_per_s": round(requests / small, 1),
+        "rejected_req_per_s": round(requests / rejected, 1),
+        "stream_mb_per_s": round(size / streamed / 1048576, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--stream-mb", type=int, default=256)
+    args = parser.parse_args()
+
+    results = {
+        "before": asyncio.run(run(before_app(), args.requests, args.stream_mb)),
+        "after": asyncio.run(run(after_app(), args.requests, args.stream_mb)),
+    }
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+# Local stand-ins for the external services Fido talks to, so benchmarks can
+# run on an offline box: a fake Podcast Index API and a media server with
+# configurable latency and bandwidth.
+
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class _Server:
+    handler: type[BaseHTTPRequestHandler]
+
+    def start(self):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), self.handler)
+        self.httpd.daemon_threads = True
+        self.httpd.owner = self
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.httpd.server_port}"
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class _IndexHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        index: FakeIndex = self.server.owner
+        length = int(self.headers.get("content-length", 0))
+        params = {k: v[0] for k, v in parse_qs(self.rfile.read(length).decode()).items()}
+        if index.latency:
+            time.sleep(index.latency)
+
+        path = urlparse(self.path).path.removeprefix("/api/1.0")
+        if path == "/search/byterm":
+            body = index.search(params.get("q", ""))
+        elif path == "/podcasts/byfeedid":
+            body = index.feed(int(params["id"]))
+        elif path == "/episodes/byfeedid":
+            body = index.episodes(
+                int(params["id"]), int(params.get("max", 10)), int(params.get("since", 0))
+            )
+        else:
+            body = None
+
+        if body == None:
+            self.send_response(404)
+            self.send_header("content-length", "0")
+            self.end_headers()
+            return
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(200)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class FakeIndex(_Server):
+    handler = _IndexHandler
+
+    def __init__(
+        self,
+        media_url: str,
+        feeds: dict[int, int] = {1: 10},
+        latency: float = 0,
+    ):
+        self.latency = latency
+        self.feeds = {
+            feed_id: {
+                "id": feed_id,
+                "title": f"Bench Feed {feed_id}",
+                "url": f"{media_url}/feeds/{feed_id}.xml",
+                "contentType": "application/rss+xml",
+                "author": "Fido Bench",
+                "link": f"{media_url}/feeds/{feed_id}",
+                "description": "Synthetic feed for benchmarking " * 4,
+                "image": f"{media_url}/feeds/{feed_id}.jpg",
+            }
+            for feed_id in feeds.keys()
+        }
+        self.items = {
+            feed_id: [
+                {
+                    "id": feed_id * 1000000 + n,
+                    "title": f"Episode {n}",
+                    "link": f"{media_url}/feeds/{feed_id}/{n}",
+                    "description": f"Episode {n} of a synthetic benchmark feed. " * 8,
+                    "datePublished": 1600000000 + (count - n) * 3600,
+                    "enclosureUrl": f"{media_url}/media/{feed_id}/{n}.mp3",
+                    "enclosureType": "audio/mpeg",
+                    "duration": 3600,
+                    "explicit": 0,
+                    "episode": n,
+                    "episodeType": "full",
+                    "season": 1,
+                    "image": f"{media_url}/feeds/{feed_id}/{n}.jpg",
+                    "feedId": feed_id,
+                }
+                for n in range(count)
+            ]
+            for feed_id, count in feeds.items()
+        }
+
+    def search(self, query: str) -> dict:
+        return {"status": "true", "feeds": list(self.feeds.values()), "count": len(self.feeds)}
+
+    def feed(self, feed_id: int) -> dict:
+        return {"status": "true", "feed": self.feeds.get(feed_id, [])}
+
+    def episodes(self, feed_id: int, limit: int, since: int) -> dict:
+        items = [i for i in self.items.get(feed_id, []) if i["datePublished"] >= since]
+        return {"status": "true", "items": items[:limit], "count": min(len(items), limit)}
+
+
+class _MediaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.do_GET(body=False)
+
+    def do_GET(self, body: bool = True):
+        media: MediaServer = self.server.owner
+        if media.latency:
+            time.sleep(media.latency)
+        data = media.data
+        start, end, code = 0, len(data) - 1, 200
+        if "range" in self.headers.keys():
+            first, _, last = self.headers["range"].removeprefix("bytes=").partition("-")
+            start = int(first) if first else len(data) - int(last)
+            end = int(last) if first and last else len(data) - 1
+            code = 206
+
+        self.send_response(code)
+        self.send_header("content-type", "audio/mpeg")
+        self.send_header("content-length", str(end - start + 1))
+        self.send_header("accept-ranges", "bytes")
+        if code == 206:
+            self.send_header("content-range", f"bytes {start}-{end}/{len(data)}")
+        self.end_headers()
+        if not body:
+            return
+
+        view = memoryview(data)[start : end + 1]
+        chunk = 65536
+        started = time.monotonic()
+        for offset in range(0, len(view), chunk):
+            self.wfile.write(view[offset : offset + chunk])
+            if media.bandwidth:
+                ahead = (offset + chunk) / media.bandwidth - (time.monotonic() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+
+class MediaServer(_Server):
+    handler = _MediaHandler
+
+    def __init__(self, size: int = 16777216, latency: float = 0, bandwidth: float = 0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.data = random.Random(0).randbytes(size)
@@ -0,0 +1,338 @@
+# Offline end-to-end benchmark suite.
+#
+#   pip install -r bench/requirements.txt
+#   python bench/run.py --output results.json
+#   python bench/run.py --quick --compare results.json
+#
+# Starts a fake Podcast Index API and media server on localhost, boots the
+# real app under uvicorn against a local fsspec target in a temporary
+# directory, and reports download throughput, /files streaming rate, endpoint
+# latency under concurrent load and tracker DB contention as JSON.
+
+import argparse, asyncio, json, os, platform, shutil, socket, subprocess, sys
+import tempfile, threading, time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(ROOT, "..", "server"))
+sys.path.insert(0, ROOT)
+
+import httpx
+from fakes import FakeIndex, MediaServer
+
+BULK_FEED = 1
+DOWNLOAD_FEED = 2
+
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def make_config(workdir: str, index_url: str, args) -> dict:
+    return {
+        "authenticated": False,
+        "api_keys": {},
+        "target": {
+            "module": "local",
+            "subclass": "LocalFileSystem",
+            "args": [],
+            "kwargs": {},
+            "root_path": os.path.join(workdir, "target"),
+        },
+        "db": os.path.join(workdir, "db.json"),
+        "db_downloads": os.path.join(workdir, "downloads.sqlite"),
+        "download_tracker": {"backend": "sqlite"},
+        "download_workers": args.download_workers,
+        "scan_interval": 3600,
+        "download_entry_clear": 3600,
+        "modules": {
+            "podcasts": {
+                "slug": "podcasts",
+                "display": "Podcasts",
+                "active": True,
+                "key": {"api_key": "bench", "api_secret": "bench"},
+                "table": "podcasts",
+                "base_url": index_url + "/api/1.0",
+            }
+        },
+    }
+
+
+def start_app(config_path: str, port: int):
+    os.environ["CONFIG_FILE"] = config_path
+    import uvicorn
+    import main
+
+    server = uvicorn.Server(
+        uvicorn.Config(main.app, host="127.0.0.1", port=port, log_level="warning")
+    )
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+async def load(base: str, path: str, requests: int, concurrency: int) -> dict:
+    timings = []
+    errors = 0
+    queue = iter(range(requests))
+
+    async with httpx.AsyncClient(base_url=base, timeout=60) as client:
+        await client.get(path)
+
+        async def worker():
+            nonlocal errors
+            for _ in queue:
+                started = time.perf_counter()
+                r = await client.get(path)
+                timings.append(time.perf_counter() - started)
+                if r.status_code >= 400:
+                    errors += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        elapsed = time.perf_counter() - started
+
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "errors": errors,
+        "req_per_s": round(requests / elapsed, 1),
+        "p50_ms": round(percentile(timings, 50) * 1000, 2),
+        "p90_ms": round(percentile(timings, 90) * 1000, 2),
+        "p99_ms": round(percentile(timings, 99) * 1000, 2),
+    }
+
+
+def bench_latency(base: str, args) -> dict:
+    endpoints = {
+        "root": "/",
+        "search": "/podcasts/search?query=bench",
+        "episodes_page": f"/podcasts/episodes/{BULK_FEED}?limit=100",
+        "episodes_full": f"/podcasts/episodes/{BULK_FEED}",
+        "files_listing": "/files/",
+    }
+    return {
+        name: asyncio.run(load(base, path, args.requests, args.concurrency))
+        for name, path in endpoints.items()
+    }
+
+
+def bench_download(base: str, args) -> dict:
+    started = time.perf_counter()
+    records = httpx.get(
+        f"{base}/podcasts/download/feed/{DOWNLOAD_FEED}", timeout=60
+    ).json()
+    download_id = records[0]["download_id"]
+    while True:
+        status = httpx.get(f"{base}/podcasts/download/{download_id}").json()["value"]
+        if all(r["type"] in ["complete", "error", "cancelled", "skipped"] for r in status):
+            break
+        time.sleep(0.05)
+    elapsed = time.perf_counter() - started
+    total = sum(
+        r["message"].get("total_size") or 0
+        for r in status
+        if isinstance(r["message"], dict)
+    )
+    return {
+        "items": len(status),
+        "failed": len([r for r in status if r["type"] != "complete"]),
+        "bytes": total,
+        "seconds": round(elapsed, 3),
+        "mb_per_s": round(total / elapsed / 1048576, 1),
+        "paths": [r["path"] for r in status],
+    }
+
+
+def bench_files(base: str, path: str, args) -> dict:
+    results = {}
+    with httpx.Client(base_url=base, timeout=60) as client:
+        for name, headers in [("full", {}), ("range", {"range": "bytes=1048576-"})]:
+            size = 0
+            started = time.perf_counter()
+            for _ in range(args.stream_repeats):
+                with client.stream("GET", f"/files/{path}", headers=headers) as r:
+                    r.raise_for_status()
+                    for chunk in r.iter_raw():
+                        size += len(chunk)
+            elapsed = time.perf_counter() - started
+            results[name] = {
+                "bytes": size,
+                "mb_per_s": round(size / elapsed / 1048576, 1),
+            }
+    return results
+
+
+def bench_trackers(workdir: str, args) -> dict:
+    from util.trackers import make_tracker_store
+
+    results = {}
+    for backend, path in [("tinydb", "trackers.json"), ("sqlite", "trackers.sqlite")]:
+        store = make_tracker_store(os.path.join(workdir, path), backend=backend)
+        downloads = [f"d{i}" for i in range(args.tracker_downloads)]
+        store.insert_many(
+            [
+                {
+                    "type": "queued",
+                    "path": f"bench/{d}/{n}",
+                    "startedTimestamp": None,
+                    "completedTimestamp": None,
+                    "message": "Queued",
+                    "container": "bench",
+                    "download_id": d,
+                    "item_id": str(n),
+                }
+                for d in downloads
+                for n in range(args.tracker_items)
+            ]
+        )
+        stop = threading.Event()
+        counts = {"updates": 0, "searches": 0}
+        reads = []
+
+        def writer(offset: int):
+            n = offset
+            while not stop.is_set():
+                d = downloads[n % len(downloads)]
+                store.update(d, str(n % args.tracker_items), {"type": "in_progress", "message": n})
+                counts["updates"] += 1
+                n += 1
+
+        def reader():
+            n = 0
+            while not stop.is_set():
+                started = time.perf_counter()
+                store.search(downloads[n % len(downloads)])
+                reads.append(time.perf_counter() - started)
+                counts["searches"] += 1
+                n += 1
+
+        threads = [threading.Thread(target=writer, args=(i,)) for i in range(args.tracker_writers)]
+        threads.append(threading.Thread(target=reader))
+        for t in threads:
+            t.start()
+        time.sleep(args.tracker_seconds)
+        stop.set()
+        for t in threads:
+            t.join()
+        store.close()
+        results[backend] = {
+            "updates_per_s": round(counts["updates"] / args.tracker_seconds, 1),
+            "searches_per_s": round(counts["searches"] / args.tracker_seconds, 1),
+            "search_p50_ms": round(percentile(reads, 50) * 1000, 3),
+            "search_p99_ms": round(percentile(reads, 99) * 1000, 3),
+        }
+    return results
+
+
+def flatten(value, prefix: str = "") -> dict[str, float]:
+    if isinstance(value, dict):
+        out = {}
+        for k, v in value.items():
+            out.update(flatten(v, f"{prefix}.{k}" if prefix else k))
+        return out
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return {prefix: value}
+    return {}
+
+
+def compare(baseline: dict, current: dict):
+    before = flatten(baseline["results"])
+    after = flatten(current["results"])
+    for key in sorted(set(before.keys()) & set(after.keys())):
+        if before[key]:
+            change = (after[key] - before[key]) / before[key] * 100
+            print(f"{key:55} {before[key]:>12} {after[key]:>12} {change:+8.1f}%")
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", help="write results JSON to this file")
+    parser.add_argument("--compare", help="baseline results JSON to compare against")
+    parser.add_argument("--quick", action="store_true", help="smaller run for smoke testing")
+    parser.add_argument("--episodes", type=int, default=5000)
+    parser.add_argument("--media-size", type=int, default=64 * 1048576)
+    parser.add_argument("--media-latency", type=float, default=0.02)
+    parser.add_argument("--media-bandwidth", type=float, default=0, help="bytes/s per connection, 0 = unlimited")
+    parser.add_argument("--index-latency", type=float, default=0.05)
+    parser.add_argument("--download-items", type=int, default=8)
+    parser.add_argument("--download-workers", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--stream-repeats", type=int, default=4)
+    parser.add_argument("--tracker-downloads", type=int, default=50)
+    parser.add_argument("--tracker-items", type=int, default=20)
+    parser.add_argument("--tracker-writers", type=int, default=4)
+    parser.add_argument("--tracker-seconds", type=float, default=5)
+    args = parser.parse_args()
+    if args.quick:
+        args.episodes, args.media_size, args.download_items = 500, 8 * 1048576, 4
+        args.requests, args.concurrency, args.stream_repeats = 200, 8, 1
+        args.tracker_seconds = 1
+
+    workdir = tempfile.mkdtemp(prefix="fido-bench-")
+    os.makedirs(os.path.join(workdir, "target"))
+    media = MediaServer(args.media_size, args.media_latency, args.media_bandwidth).start()
+    index = FakeIndex(
+        media.url,
+        {BULK_FEED: args.episodes, DOWNLOAD_FEED: args.download_items},
+        latency=args.index_latency,
+    ).start()
+    config_path = os.path.join(workdir, "config.json")
+    with open(config_path, "w") as f:
+        json.dump(make_config(workdir, index.url, args), f)
+
+    try:
+        server = start_app(config_path, free_port())
+        base = f"http://127.0.0.1:{server.config.port}"
+        results = {}
+        results["download"] = bench_download(base, args)
+        results["files_stream"] = bench_files(base, results["download"]["paths"][0], args)
+        del results["download"]["paths"]
+        results["latency"] = bench_latency(base, args)
+        results["trackers"] = bench_trackers(workdir, args)
+        server.should_exit = True
+    finally:
+        media.stop()
+        index.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "timestamp": time.time(),
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "params": vars(args),
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+    else:
+        print(json.dumps(report, indent=4))
+
+
+if __name__ == "__main__":
+    main()
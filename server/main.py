@@ -1,4 +1,4 @@
-import dotenv, os, json, base64
+import dotenv, os, json, base64, asyncio
 
 dotenv.load_dotenv()
 
@@ -18,16 +18,18 @@ else:
 
 os.environ["RAW_CONFIG"] = json.dumps(CONFIG)
 
-from util import TargetFileSystem, Resource, cfg
+from util import get_target, Resource, AuthMiddleware, CompressionMiddleware, cfg
+from util.metrics import REGISTRY, MetricsMiddleware
+from util.profiling import ProfilingMiddleware, get_profile_store
 from fastapi import FastAPI, Request, Response
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi_restful.tasks import repeat_every
 from starlette.status import *
-from routes import routers
+from routes import active_modules, mount_modules
 
 import logging
 
-FS = TargetFileSystem(**CONFIG["target"])
+FS = get_target()
 log = logging.getLogger("uvicorn.error")
 
 if not CONFIG["authenticated"]:
@@ -35,58 +37,55 @@ if not CONFIG["authenticated"]:
 
 app = FastAPI()
 
-@app.on_event("startup")
 @repeat_every(seconds=cfg()["scan_interval"])
 def run_repeat_tasks():
+    if not FS.leader("tasks", cfg()["scan_interval"] * 3):
+        return
     FS.clear_old_download_trackers()
+    for task in tasks:
+        task()
+
 
+@app.on_event("startup")
+async def start_repeat_tasks():
+    # Newer fastapi_restful versions await the repeat loop itself, which would block startup
+    app.state.repeat_tasks = asyncio.ensure_future(run_repeat_tasks())
+
+
+METRICS = CONFIG.get("metrics", {})
+PROFILING = CONFIG.get("profiling", {})
+COMPRESSION = CONFIG.get("compression", {})
+
+if PROFILING.get("enabled", False):
+    app.add_middleware(
+        ProfilingMiddleware,
+        store=get_profile_store(),
+        authenticated=CONFIG["authenticated"],
+        sample_rate=PROFILING.get("sample_rate", 0),
+        mode=PROFILING.get("mode", "sampling"),
+        interval=PROFILING.get("interval", 0.005),
+    )
+app.add_middleware(
+    AuthMiddleware,
+    authenticated=CONFIG["authenticated"],
+    api_keys=CONFIG["api_keys"],
+    public=("redoc", "metrics") if METRICS.get("public", False) else ("redoc",),
+)
+if COMPRESSION.get("enabled", True):
+    app.add_middleware(
+        CompressionMiddleware,
+        min_size=COMPRESSION.get("min_size", 1024),
+        level=COMPRESSION.get("level", 1),
+        offload_size=COMPRESSION.get("offload_size", 65536),
+    )
+if METRICS.get("enabled", True):
+    app.add_middleware(MetricsMiddleware)
 
-@app.middleware("http")
-async def authenticate(request: Request, call_next):
-    if CONFIG["authenticated"] and not request.url.path.strip("/").startswith("redoc"):
-        # Check if header exists
-        if not "Authorization" in request.headers.keys():
-            log.warning(f"Got no-auth request from {request.client.host}")
-            return JSONResponse(
-                content={
-                    "result": "failure",
-                    "message": "Authorization header not included",
-                },
-                status_code=HTTP_401_UNAUTHORIZED,
-            )
-
-        # Check if API key is valid
-        if not request.headers["Authorization"] in CONFIG["api_keys"].keys():
-            log.warning(
-                f"Got bad-auth request from {request.client.host} with key {request.headers['Authorization']}"
-            )
-            return JSONResponse(
-                content={"result": "failure", "message": "Incorrect API key"},
-                status_code=HTTP_401_UNAUTHORIZED,
-            )
-
-        key = CONFIG["api_keys"][request.headers["Authorization"]]
-
-        # Check if client can access path
-        if not any([request.url.path.startswith(p) for p in key["scope"]]):
-            log.warning(
-                f"Got bad-scope request from {request.client.host} with key {key['name']} to path {request.url.path}"
-            )
-            return JSONResponse(
-                content={
-                    "result": "failure",
-                    "message": "Do not have scope to access path",
-                },
-                status_code=HTTP_403_FORBIDDEN,
-            )
-
-        log.debug(
-            f"Got request to {request.url.path} from {key['name']} @ {request.client.host}"
+    @app.get("/metrics", include_in_schema=False)
+    async def metrics():
+        return PlainTextResponse(
+            REGISTRY.render(), media_type="text/plain; version=0.0.4"
         )
-    else:
-        log.debug(f"Got request to {request.url.path} from {request.client.host}")
-    response = await call_next(request)
-    return response
 
 
 @app.get("/")
@@ -98,11 +97,11 @@ async def root():
         },
         "modules": [
             {"slug": i["slug"], "displayName": i["display"]}
-            for i in CONFIG["modules"].values()
-            if i["active"]
+            for k, i in CONFIG["modules"].items()
+            if k in ACTIVE.keys()
         ],
         "keys": len(CONFIG["api_keys"].keys()),
     }
 
-for r in routers:
-    app.include_router(r)
\ No newline at end of file
+ACTIVE = active_modules(CONFIG["modules"])
+tasks = mount_modules(app, ACTIVE)
\ No newline at end of file
@@ -1,9 +1,44 @@
-from .podcast_router import router as PodcastRouter
-from .filesystem_viewer import router as FSRouter
+from importlib import import_module
+from time import perf_counter
+import logging
 
-routers = [
-    PodcastRouter,
-    FSRouter
-]
+log = logging.getLogger("uvicorn.error")
 
-__all__ = ["routers"]
\ No newline at end of file
+# Always mounted
+CORE = {"files": ".filesystem_viewer", "admin": ".admin"}
+
+# Keyed like CONFIG["modules"]; imported only when the module is active
+MODULES = {"podcasts": ".podcast_router"}
+
+
+def active_modules(modules: dict) -> dict[str, str]:
+    active = dict(CORE)
+    for slug, options in modules.items():
+        if not options.get("active", False):
+            continue
+        if not slug in MODULES.keys():
+            log.warning(f"Module {slug} is active but has no router, skipping")
+            continue
+        active[slug] = MODULES[slug]
+    return active
+
+
+def mount_modules(app, active: dict[str, str]) -> list:
+    tasks = []
+    started = perf_counter()
+    for slug, path in active.items():
+        began = perf_counter()
+        module = import_module(path, __name__)
+        imported = perf_counter()
+        app.include_router(module.router)
+        tasks.extend(getattr(module, "tasks", []))
+        log.info(
+            f"Loaded module {slug} in {(perf_counter() - began) * 1000:.1f} ms "
+            f"(import {(imported - began) * 1000:.1f} ms, "
+            f"mount {(perf_counter() - imported) * 1000:.1f} ms)"
+        )
+    log.info(f"Loaded all modules in {(perf_counter() - started) * 1000:.1f} ms")
+    return tasks
+
+
+__all__ = ["active_modules", "mount_modules"]
@@ -0,0 +1,55 @@
+from fastapi import Body
+from fastapi.responses import FileResponse
+from fastapi.routing import APIRouter
+from starlette.status import *
+from util import err, suc, shaper, offload
+from util.profiling import get_profile_store
+
+router = APIRouter(prefix="/admin", tags=["admin"])
+
+__all__ = ["router"]
+
+
+@router.get("/bandwidth")
+async def get_bandwidth():
+    return suc(shaper.settings())
+
+
+@router.put("/bandwidth")
+async def set_bandwidth(
+    limit: float | None = Body(None),
+    hosts: dict[str, float] | None = Body(None),
+    per_host: float | None = Body(None),
+    schedule: list[dict] | None = Body(None),
+):
+    try:
+        shaper.configure(limit=limit, hosts=hosts, per_host=per_host, schedule=schedule)
+    except ValueError as e:
+        return err(HTTP_400_BAD_REQUEST, str(e))
+    return suc(shaper.settings())
+
+
+@router.get("/profiles")
+async def list_profiles():
+    return suc(await offload("storage", get_profile_store().list))
+
+
+@router.get("/profiles/{id}")
+async def get_profile(id: str):
+    meta = await offload("storage", get_profile_store().get, id)
+    if meta == None:
+        return err(HTTP_404_NOT_FOUND, f"Profile {id} not found")
+    return FileResponse(
+        meta["local"],
+        filename=meta["file"],
+        media_type="text/plain" if meta["mode"] == "sampling" else "application/octet-stream",
+    )
+
+
+@router.delete("/profiles/{id}")
+async def delete_profile(id: str):
+    store = get_profile_store()
+    if await offload("storage", store.get, id) == None:
+        return err(HTTP_404_NOT_FOUND, f"Profile {id} not found")
+    await offload("storage", store.remove, id)
+    return suc({"removed": id})
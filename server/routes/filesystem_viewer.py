@@ -1,32 +1,60 @@
 from starlette.status import *
-from fastapi.responses import StreamingResponse
+from fastapi import Request, Response
+from fastapi.responses import FileResponse
 from fastapi.routing import APIRouter
-from util import TargetFileSystem, cfg, err, suc
+from util import get_target, cfg, err, suc, offload
+from util.streaming import block_size, not_modified, stream_file, validators
 import mimetypes
+from typing import Literal
 
 router = APIRouter(prefix="/files", tags=["files"])
-fs = TargetFileSystem(**cfg()["target"])
+fs = get_target()
 
 __all__ = ["router"]
 
 @router.get("/{sl_path:path}")
-async def get_at(sl_path: str):
-    print(sl_path)
-    if fs.exists(sl_path):
-        if fs.isdir(sl_path):
-            items = fs.ls(sl_path)
-            return suc({
-                "path": sl_path,
-                "items": [{
-                    "path": str(i).rsplit("/", maxsplit=1)[1],
-                    "is_directory": fs.isdir(sl_path + "/" + str(i).rsplit("/", maxsplit=1)[1])
-                } for i in items]
-            })
-        else:
-            def iterfile():
-                with fs.open(sl_path, mode="rb") as f:
-                    yield from f
-            
-            return StreamingResponse(iterfile(), media_type=mimetypes.guess_type(sl_path)[0])
-    else:
-        return err(HTTP_404_NOT_FOUND, "File not found")
\ No newline at end of file
+async def get_at(
+    request: Request,
+    sl_path: str,
+    offset: int = 0,
+    limit: int | None = None,
+    sort: Literal["path", "-path", "size", "-size", "modified", "-modified"] | None = None,
+):
+    info = fs.staged_info(sl_path)
+    if info == None:
+        try:
+            info = await offload("storage", fs.info, sl_path)
+        except FileNotFoundError:
+            return err(HTTP_404_NOT_FOUND, "File not found")
+
+    if info["type"] == "directory":
+        items = await offload("storage", fs.listing, sl_path)
+        if sort:
+            key = sort.lstrip("-")
+            items = sorted(
+                items,
+                key=lambda i: (i[key] is None, i[key]),
+                reverse=sort.startswith("-"),
+            )
+        page = items[offset : (offset + limit if limit != None else None)]
+        return suc({
+            "path": sl_path,
+            "items": page,
+            "offset": offset,
+            "total": len(items),
+            "next": offset + len(page) if offset + len(page) < len(items) else None,
+        })
+
+    headers = validators(info)
+    if not_modified(request.headers, info, headers["etag"]):
+        return Response(status_code=HTTP_304_NOT_MODIFIED, headers=headers)
+
+    media_type = mimetypes.guess_type(sl_path)[0] or "application/octet-stream"
+    if fs.is_local or "local" in info.keys():
+        # FileResponse handles ranges itself and uses pathsend where the server supports it
+        response = FileResponse(
+            info.get("local") or fs._path(sl_path), headers=headers, media_type=media_type
+        )
+        response.chunk_size = block_size()
+        return response
+    return stream_file(fs, sl_path, info, request.headers, media_type, headers)
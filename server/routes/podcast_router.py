@@ -1,41 +1,121 @@
-import mimetypes
-from typing import List
+from typing import List, Literal
 from xmlrpc.client import boolean
-from fastapi import Query, Request, Response
+from fastapi import Body, Query, Request, Response
+from fastapi.responses import StreamingResponse
 from fastapi.routing import APIRouter
-from more_itertools import unzip
-from util import Podcast, PodcastEpisode, cfg, TargetFileSystem, err, suc
+from util.metrics import gauge
+from util import (
+    Podcast,
+    PodcastEpisode,
+    cfg,
+    get_target,
+    shared,
+    shared_items,
+    CachedIndex,
+    ResourceStore,
+    AutoFetcher,
+    offload,
+    dumps,
+    etag,
+    fresh,
+    not_modified_response,
+    safe_name,
+    progress,
+    err,
+    suc,
+)
 import podcastindex
-import tinydb
-from tinydb import where
+import os
+from time import monotonic, time
+import asyncio
 from requests.exceptions import *
 from starlette.status import *
-import string
 
-__all__ = ["router"]
+__all__ = ["router", "tasks"]
 
 router = APIRouter(prefix="/podcasts", tags=["podcasts"])
-index = podcastindex.init(cfg()["modules"]["podcasts"]["key"])
-fs = TargetFileSystem(**cfg()["target"])
-table = tinydb.TinyDB(cfg()["db"]).table(cfg()["modules"]["podcasts"]["table"])
+options = cfg()["modules"]["podcasts"]
+fs = get_target()
+saved_cache = {"revision": None, "value": {}}
+
+
+def _make_index() -> CachedIndex:
+    client = podcastindex.init(options["key"])
+    if "base_url" in options.keys():
+        client.base_url = options["base_url"].rstrip("/")
+    return CachedIndex(client, **options.get("cache", {}))
+
+
+def get_index() -> CachedIndex:
+    return shared("index", "podcasts", _make_index)
+
+
+def get_store() -> ResourceStore:
+    path = cfg().get("feed_store", os.path.splitext(cfg()["db"])[0] + ".sqlite")
+    return shared(
+        "store",
+        (path, options["table"]),
+        lambda: ResourceStore(path, options["table"], migrate_from=cfg()["db"]),
+    )
+
+
+def get_autofetcher() -> AutoFetcher:
+    return shared(
+        "autofetcher",
+        "podcasts",
+        lambda: AutoFetcher(
+            get_index().index, get_store(), fs, cfg()["scan_interval"]
+        ),
+    )
+
+
+def schedule_autofetch():
+    get_autofetcher().schedule()
+
+
+def _cache_events():
+    index = shared_items("index").get("podcasts")
+    if index == None:
+        return None
+    return {(k,): v for k, v in index.stats().items() if k in ["hits", "misses", "coalesced"]}
+
+
+gauge(
+    "fido_index_cache_events_total",
+    "Index API response cache lookups by outcome",
+    _cache_events,
+    ("outcome",),
+    kind="counter",
+)
+tasks = [schedule_autofetch]
 
 
 @router.get("/search")
-async def search_by_term(query: str, clean: bool | None = False):
+async def search_by_term(request: Request, query: str, clean: bool | None = False):
+    tag = etag(get_index().version("search", query, clean=clean))
+    if fresh(request, tag):
+        return not_modified_response(tag)
     try:
-        raw_data = index.search(query, clean=clean)
+        raw_data, tag = await offload(
+            "index", get_index().versioned("search"), query, clean=clean
+        )
     except HTTPError:
         return err(HTTP_400_BAD_REQUEST, "Failed to get feeds from Index API")
     except ReadTimeout:
         return err(HTTP_408_REQUEST_TIMEOUT, "Request to Index API timed out")
     casts = {f["id"]: Podcast.from_feed(f).to_dict_clean() for f in raw_data["feeds"]}
-    return suc(casts)
+    return suc(casts, tag=etag(tag))
+
+
+@router.get("/cache")
+async def get_cache_stats():
+    return suc(get_index().stats())
 
 
 @router.put("/saved/feeds/{id}")
 async def save_feed(id: int):
     try:
-        raw_data = index.podcastByFeedId(id)
+        raw_data = await offload("index", get_index().podcastByFeedId, id)
     except HTTPError:
         return err(HTTP_400_BAD_REQUEST, "Failed to get feed from Index API")
     except ReadTimeout:
@@ -43,7 +123,7 @@ async def save_feed(id: int):
 
     if raw_data["feed"]:
         cast = Podcast.from_feed(raw_data["feed"])
-        cast.save(table)
+        await offload("db", cast.save, await offload("db", get_store))
         return suc({"save_id": cast.__uuid__, "feed": cast.to_dict_clean()})
     else:
         return err(HTTP_404_NOT_FOUND, f"Failed to locate feed with id {id}")
@@ -51,59 +131,225 @@ async def save_feed(id: int):
 
 @router.delete("/saved/feeds/{uuid}")
 async def delete_saved_feed(uuid: str):
-    removed = table.remove(where("__uuid__") == uuid)
-    return suc({"removed": len(removed)})
+    store = await offload("db", get_store)
+    removed = await offload("db", store.remove, uuid)
+    return suc({"removed": removed})
+
+
+async def lookup(func, *args, **kwargs) -> tuple[dict | None, str | None]:
+    try:
+        return await offload("index", func, *args, **kwargs), None
+    except HTTPError:
+        return None, "Failed to get data from Index API"
+    except ReadTimeout:
+        return None, "Request to Index API timed out"
+
+
+async def lookup_feeds(ids: list[int]) -> dict[int, tuple[dict | None, str | None]]:
+    # Concurrency is bounded by the "index" upstream pool
+    results = await asyncio.gather(
+        *[lookup(get_index().podcastByFeedId, id) for id in ids]
+    )
+    return dict(zip(ids, results))
+
+
+def batch_error(items: list):
+    limit = options.get("batch_limit", 1000)
+    if len(items) == 0:
+        return err(HTTP_400_BAD_REQUEST, "Batch is empty")
+    if len(items) > limit:
+        return err(HTTP_400_BAD_REQUEST, f"Batches are limited to {limit} items")
+    return None
+
+
+@router.put("/saved/feeds")
+async def save_feeds(ids: List[int] = Body(..., embed=True)):
+    ids = list(dict.fromkeys(ids))
+    error = batch_error(ids)
+    if error:
+        return error
+
+    store = await offload("db", get_store)
+    results = {
+        id: {"status": "exists", "save_id": uuid}
+        for id, uuid in (await offload("db", store.uuids_by_feed, ids)).items()
+    }
+
+    casts = []
+    for id, (raw_data, reason) in (
+        await lookup_feeds([i for i in ids if not i in results.keys()])
+    ).items():
+        if reason:
+            results[id] = {"status": "error", "reason": reason}
+        elif not raw_data["feed"]:
+            results[id] = {"status": "not_found"}
+        else:
+            cast = Podcast.from_feed(raw_data["feed"])
+            casts.append(cast)
+            results[id] = {
+                "status": "saved",
+                "save_id": cast.__uuid__,
+                "feed": cast.to_dict_clean(),
+            }
+
+    if len(casts) > 0:
+        await offload("db", store.upsert_many, [c.to_dict() for c in casts])
+    return suc({id: results[id] for id in ids})
+
+
+@router.delete("/saved/feeds")
+async def delete_saved_feeds(uuids: List[str] = Body(..., embed=True)):
+    uuids = list(dict.fromkeys(uuids))
+    error = batch_error(uuids)
+    if error:
+        return error
+
+    store = await offload("db", get_store)
+    found = await offload("db", store.existing, uuids)
+    removed = await offload("db", store.remove_many, found)
+    return suc(
+        {
+            "removed": removed,
+            "results": {u: "removed" if u in found else "not_found" for u in uuids},
+        }
+    )
 
 @router.post("/saved/feeds/{uuid}/fetch")
 async def set_fetch_mode(uuid: str, f: boolean):
-    r = table.update({"autofetch": f}, where("__uuid__") == uuid)
-    if len(r) > 0:
-        return suc(Podcast.from_db(table, where("__uuid__") == uuid).to_dict_clean())
+    store = await offload("db", get_store)
+    doc = await offload("db", store.get, uuid)
+    fields = {"autofetch": f}
+    if f and doc and doc.get("last_seen") == None:
+        fields["last_seen"] = int(time())
+    if await offload("db", store.update, uuid, fields):
+        cast = await offload("db", Podcast.from_store, store, uuid)
+        return suc(cast.to_dict_clean())
     else:
         return err(HTTP_404_NOT_FOUND, reason=f"Saved podcast with UUID {uuid} not found.")
 
 
+def saved_feeds() -> tuple[str, dict]:
+    store = get_store()
+    version = store.version
+    if saved_cache["revision"] != version:
+        saved_cache["value"] = {
+            c["__uuid__"]: Podcast.from_raw(c).to_dict_clean() for c in store.all()
+        }
+        saved_cache["revision"] = version
+    return version, saved_cache["value"]
+
+
+def saved_feed(uuid: str) -> tuple[str, Podcast | None]:
+    store = get_store()
+    return store.version, Podcast.from_store(store, uuid)
+
+
 @router.get("/saved/feeds")
-async def get_saved_feeds():
-    casts = [Podcast.from_raw(c) for c in table.all()]
-    return suc({cast.__uuid__: cast.to_dict_clean() for cast in casts})
+async def get_saved_feeds(request: Request):
+    version, casts = await offload("db", saved_feeds)
+    tag = etag(version)
+    if fresh(request, tag):
+        return not_modified_response(tag)
+    return suc(casts, tag=tag)
 
 
 @router.get("/saved/feeds/{uuid}")
-async def get_saved_feeds(uuid: str):
-    cast = Podcast.from_db(table, where("__uuid__") == uuid)
+async def get_saved_feed(request: Request, uuid: str):
+    version, cast = await offload("db", saved_feed, uuid)
+    tag = etag(version)
+    if fresh(request, tag):
+        return not_modified_response(tag)
     if cast:
-        return suc(cast.to_dict_clean())
+        return suc(cast.to_dict_clean(), tag=tag)
     else:
         return err(HTTP_404_NOT_FOUND, f"Failed to locate saved podcast {uuid}")
 
 
+def select_fields(data: dict, fields: list[str]):
+    if len(fields) == 0:
+        return data
+    return {k: v for k, v in data.items() if k in fields}
+
+
 @router.get("/episodes/{id}")
-async def get_episodes_by_feed_id(id: str):
+async def get_episodes_by_feed_id(
+    request: Request,
+    id: str,
+    offset: int = Query(0, ge=0),
+    limit: int | None = Query(None, ge=1),
+    fields: List[str] = Query([]),
+    sort: Literal["publishDate", "-publishDate"] | None = None,
+    stream: bool = False,
+):
+    tag = etag(get_index().version("episodesByFeedId", id, max_results=10000))
+    if fresh(request, tag):
+        return not_modified_response(tag)
     try:
-        raw_data = index.episodesByFeedId(id, max_results=10000)
+        raw_data, tag = await offload(
+            "index", get_index().versioned("episodesByFeedId"), id, max_results=10000
+        )
     except HTTPError:
         return err(HTTP_400_BAD_REQUEST, "Failed to get episodes from Index API")
     except ReadTimeout:
         return err(HTTP_408_REQUEST_TIMEOUT, "Request to Index API timed out")
+    tag = etag(tag)
 
-    eps = [PodcastEpisode.from_api_item(e) for e in raw_data["items"]]
-    return suc({i.id: i.to_dict_clean() for i in eps})
+    items = raw_data["items"]
+    if sort:
+        items = sorted(
+            items,
+            key=lambda e: e["datePublished"] or 0,
+            reverse=sort.startswith("-"),
+        )
+    total = len(items)
+    page = items[offset : (offset + limit if limit != None else None)]
+
+    if stream:
+
+        def iter_episodes():
+            for e in page:
+                yield dumps(
+                    select_fields(PodcastEpisode.from_api_item(e).to_dict_clean(), fields)
+                ) + b"\n"
+
+        return StreamingResponse(
+            iter_episodes(),
+            media_type="application/x-ndjson",
+            headers={"etag": tag, "cache-control": "no-cache"} if tag else None,
+        )
+
+    eps = [PodcastEpisode.from_api_item(e) for e in page]
+    if limit == None and offset == 0:
+        return suc({i.id: select_fields(i.to_dict_clean(), fields) for i in eps}, tag=tag)
+    return suc(
+        {
+            "items": [select_fields(i.to_dict_clean(), fields) for i in eps],
+            "offset": offset,
+            "total": total,
+            "next": offset + len(eps) if offset + len(eps) < total else None,
+        },
+        tag=tag,
+    )
 
 
 @router.get("/download/feed/{id}")
 async def download_feed(
-    request: Request, id: str, n: List[int | str] = Query([]), folder: str = None
+    request: Request,
+    id: str,
+    n: List[int | str] = Query([]),
+    folder: str = None,
+    priority: int = 0,
 ):
     try:
-        episodes: list[PodcastEpisode] = [
-            PodcastEpisode.from_api_item(e)
-            for e in index.episodesByFeedId(id, max_results=10000)["items"]
-        ]
+        raw_data = await offload(
+            "index", get_index().episodesByFeedId, id, max_results=10000
+        )
     except HTTPError:
         return err(HTTP_400_BAD_REQUEST, "Failed to get episodes from Index API")
     except ReadTimeout:
         return err(HTTP_408_REQUEST_TIMEOUT, "Request to Index API timed out")
+
+    episodes = [PodcastEpisode.from_api_item(e) for e in raw_data["items"]]
     if n and len(n) > 0:
         episodes = [
             e
@@ -113,7 +359,7 @@ async def download_feed(
 
     if not folder:
         try:
-            raw_data = index.podcastByFeedId(id)
+            raw_data = await offload("index", get_index().podcastByFeedId, id)
         except HTTPError:
             return err(HTTP_400_BAD_REQUEST, "Failed to get feed from Index API")
         except ReadTimeout:
@@ -123,35 +369,139 @@ async def download_feed(
             return err(HTTP_404_NOT_FOUND, f"Failed to locate feed with id {id}")
 
         feed = Podcast.from_feed(raw_data["feed"])
-        folder = [
-            (
-                i
-                if i in string.ascii_letters
-                or i in string.digits
-                or i in "_ (){}[]+-,:;<>=#&!$%"
-                else "-"
-            )
-            for i in feed.title
-        ].join("")
-    names, resources = unzip(
-        [(e.title + str(mimetypes.guess_extension(e.contentType)), e) for e in episodes]
-    )
+        folder = safe_name(feed.title)
 
-    downloads = fs.download(
+    downloads = await offload(
+        "storage",
+        fs.download,
         folder,
-        resources=list(resources),
-        names=[
-            [
-                (
-                    i
-                    if i in string.ascii_letters
-                    or i in string.digits
-                    or i in "_ (){}[]+-,:;<>=#&!$%"
-                    else "-"
-                )
-                for i in n
-            ].join("")
-            for n in names
-        ],
+        resources=episodes,
+        names=[e.download_name() for e in episodes],
+        priority=priority,
     )
     return downloads
+
+
+@router.post("/download/feeds")
+async def download_feeds(
+    ids: List[int] = Body(..., embed=True), priority: int = Body(0, embed=True)
+):
+    ids = list(dict.fromkeys(ids))
+    error = batch_error(ids)
+    if error:
+        return error
+
+    feeds = await lookup_feeds(ids)
+    episodes = await asyncio.gather(
+        *[
+            lookup(get_index().episodesByFeedId, id, max_results=10000)
+            for id in ids
+        ]
+    )
+
+    results = {}
+    resources, names, folders = [], [], []
+    for id, (raw_feed, reason), (raw_episodes, episodes_reason) in zip(
+        ids, [feeds[i] for i in ids], episodes
+    ):
+        reason = reason or episodes_reason
+        if reason:
+            results[id] = {"status": "error", "reason": reason}
+            continue
+        if not raw_feed["feed"]:
+            results[id] = {"status": "not_found"}
+            continue
+        try:
+            folder = safe_name(Podcast.from_feed(raw_feed["feed"]).title)
+            items = [PodcastEpisode.from_api_item(e) for e in raw_episodes["items"]]
+            item_names = [e.download_name() for e in items]
+        except Exception as e:
+            results[id] = {"status": "error", "reason": f"Failed to prepare episodes: {e}"}
+            continue
+        resources.extend(items)
+        names.extend(item_names)
+        folders.extend([folder for i in items])
+        results[id] = {"status": "queued", "folder": folder, "items": len(items)}
+
+    download_id = None
+    if len(resources) > 0:
+        records = await offload(
+            "storage",
+            fs.download,
+            None,
+            resources=resources,
+            names=names,
+            priority=priority,
+            containers=folders,
+        )
+        download_id = records[0]["download_id"]
+    return suc({"download_id": download_id, "results": {id: results[id] for id in ids}})
+
+
+@router.get("/download/{download_id}")
+async def get_download_status(download_id: str):
+    records = await offload("db", fs.download_status, download_id)
+    if len(records) > 0:
+        return suc(records)
+    else:
+        return err(HTTP_404_NOT_FOUND, f"Failed to locate download {download_id}")
+
+
+@router.get("/download/{download_id}/summary")
+async def get_download_summary(download_id: str):
+    summary = await offload("db", fs.download_summary, download_id)
+    if summary:
+        return suc(summary)
+    else:
+        return err(HTTP_404_NOT_FOUND, f"Failed to locate download {download_id}")
+
+
+@router.get("/download/{download_id}/progress")
+async def stream_download_progress(request: Request, download_id: str):
+    # In shared-queue mode these read SQLite, so they stay off the loop
+    if await offload("db", progress.version, download_id) == None:
+        return err(HTTP_404_NOT_FOUND, f"No live progress for download {download_id}")
+
+    async def events():
+        last_version = None
+        last_sent = monotonic()
+        while not await request.is_disconnected():
+            version = await offload("db", progress.version, download_id)
+            if version == None:
+                break
+            if version != last_version:
+                snapshot = await offload("db", progress.snapshot, download_id)
+                if snapshot == None:
+                    break
+                yield b"event: progress\ndata: " + dumps(snapshot) + b"\n\n"
+                last_version = version
+                last_sent = monotonic()
+                if snapshot["finished"]:
+                    yield b"event: done\ndata: {}\n\n"
+                    break
+            elif monotonic() - last_sent > 15:
+                yield b": keepalive\n\n"
+                last_sent = monotonic()
+            await asyncio.sleep(progress.interval)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"cache-control": "no-cache", "x-accel-buffering": "no"},
+    )
+
+
+@router.delete("/download/{download_id}")
+async def cancel_download(download_id: str):
+    return suc({"cancelled": await offload("db", fs.cancel_download, download_id)})
+
+
+@router.delete("/download/{download_id}/{item_id}")
+async def cancel_download_item(download_id: str, item_id: str):
+    return suc(
+        {
+            "cancelled": await offload(
+                "db", fs.cancel_download, download_id, item_id=item_id
+            )
+        }
+    )
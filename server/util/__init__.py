@@ -1,16 +1,25 @@
-from .fs import TargetFileSystem
+from .fs import TargetFileSystem, get_target
+from .cache import CachedIndex, TTLCache
+from .aio import offload, upstream
+from .store import ResourceStore
+from .registry import shared, shared_items
+from .autofetch import AutoFetcher
+from .progress import progress
+from .bandwidth import shaper
 from .models import *
-from fastapi.responses import JSONResponse
+from .responses import FastJSONResponse, dumps, etag, fresh, not_modified_response
+from .compression import CompressionMiddleware
+from .auth import AuthMiddleware
 from .cfg import *
 
 def err(code: int, reason: str = "Just because :)"):
-    return JSONResponse(content={
+    return FastJSONResponse(content={
         "result": "failure",
         "reason": reason
     }, status_code=code)
 
-def suc(data: dict | list, code: int = 200):
-    return JSONResponse(content={
+def suc(data: dict | list, code: int = 200, tag: str = None):
+    return FastJSONResponse(content={
         "result": "success",
         "value": data
-    }, status_code=code)
\ No newline at end of file
+    }, status_code=code, headers={"etag": tag, "cache-control": "no-cache"} if tag else None)
\ No newline at end of file
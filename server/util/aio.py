@@ -0,0 +1,90 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from functools import partial
+from threading import Lock
+from time import perf_counter
+
+from .cfg import cfg
+from .metrics import UPSTREAM_DURATION, UPSTREAM_ERRORS, gauge
+
+DEFAULT_CONCURRENCY = {"index": 8, "storage": 16, "db": 4, "compress": 4}
+
+# Set per request to wrap offloaded calls (used by the request profiler)
+offload_wrapper: ContextVar = ContextVar("fido_offload_wrapper", default=None)
+
+
+class Upstream:
+    def __init__(self, name: str, concurrency: int):
+        self.name = name
+        self.concurrency = concurrency
+        self.executor = ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix=f"Fido-{name}"
+        )
+        self.lock = Lock()
+        self.pending = 0
+
+    async def run(self, func, *args, **kwargs):
+        call = partial(func, *args, **kwargs)
+        wrapper = offload_wrapper.get()
+        if wrapper != None:
+            call = wrapper(call)
+        queued = True
+
+        def dequeue():
+            nonlocal queued
+            with self.lock:
+                if queued:
+                    queued = False
+                    self.pending -= 1
+
+        def started():
+            dequeue()
+            return call()
+
+        with self.lock:
+            self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor, started
+            )
+        finally:
+            # Calls cancelled while still queued never start
+            dequeue()
+
+
+_upstreams: dict[str, Upstream] = {}
+_upstreams_lock = Lock()
+
+
+def upstream(name: str) -> Upstream:
+    with _upstreams_lock:
+        if not name in _upstreams.keys():
+            limits = {**DEFAULT_CONCURRENCY, **cfg().get("concurrency", {})}
+            _upstreams[name] = Upstream(name, limits.get(name, 4))
+        return _upstreams[name]
+
+
+async def offload(name: str, func, *args, **kwargs):
+    call = getattr(func, "__name__", "call")
+    started = perf_counter()
+    try:
+        return await upstream(name).run(func, *args, **kwargs)
+    except Exception as e:
+        UPSTREAM_ERRORS.inc(1, name, call, type(e).__name__)
+        raise
+    finally:
+        UPSTREAM_DURATION.observe(perf_counter() - started, name, call)
+
+
+def _pending():
+    with _upstreams_lock:
+        return {(n,): u.pending for n, u in _upstreams.items()}
+
+
+gauge(
+    "fido_upstream_pending",
+    "Offloaded calls waiting for an executor thread",
+    _pending,
+    ("upstream",),
+)
@@ -0,0 +1,89 @@
+from hashlib import sha256
+import logging
+
+from starlette.status import *
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from .responses import FastJSONResponse
+
+log = logging.getLogger("uvicorn.error")
+
+
+class AuthMiddleware:
+    def __init__(
+        self,
+        app: ASGIApp,
+        authenticated: bool = True,
+        api_keys: dict = {},
+        public: tuple[str, ...] = ("redoc",),
+    ):
+        self.app = app
+        self.authenticated = authenticated
+        self.public = public
+        self.keys: dict[bytes, tuple[str, tuple[str, ...]]] = {}
+        for key, info in api_keys.items():
+            # Keyed by hash, so lookup timing says nothing about the key itself
+            self.keys[sha256(key.encode("utf-8")).digest()] = (
+                info["name"],
+                tuple(info["scope"]),
+            )
+
+    @staticmethod
+    def _failure(message: str, code: int):
+        return FastJSONResponse(
+            content={"result": "failure", "message": message}, status_code=code
+        )
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        path: str = scope["path"]
+        if not self.authenticated or path.strip("/").startswith(self.public):
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Got request to %s from %s", path, (scope.get("client") or ("?",))[0])
+            return await self.app(scope, receive, send)
+
+        provided = None
+        for name, value in scope["headers"]:
+            if name == b"authorization":
+                provided = value
+                break
+
+        if provided == None:
+            log.warning("Got no-auth request from %s", (scope.get("client") or ("?",))[0])
+            response = self._failure(
+                "Authorization header not included", HTTP_401_UNAUTHORIZED
+            )
+            return await response(scope, receive, send)
+
+        entry = self.keys.get(sha256(provided).digest())
+        if entry == None:
+            log.warning(
+                "Got bad-auth request from %s", (scope.get("client") or ("?",))[0]
+            )
+            response = self._failure("Incorrect API key", HTTP_401_UNAUTHORIZED)
+            return await response(scope, receive, send)
+
+        key_name, prefixes = entry
+        scope["fido.key"] = (key_name, prefixes)
+        if not path.startswith(prefixes):
+            log.warning(
+                "Got bad-scope request from %s with key %s to path %s",
+                (scope.get("client") or ("?",))[0],
+                key_name,
+                path,
+            )
+            response = self._failure(
+                "Do not have scope to access path", HTTP_403_FORBIDDEN
+            )
+            return await response(scope, receive, send)
+
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(
+                "Got request to %s from %s @ %s",
+                path,
+                key_name,
+                (scope.get("client") or ("?",))[0],
+            )
+        await self.app(scope, receive, send)
@@ -0,0 +1,95 @@
+from threading import Event, Lock, Thread
+from time import time
+import logging
+
+from .fs import TargetFileSystem
+from .models import Podcast, PodcastEpisode, safe_name
+from .store import ResourceStore
+
+log = logging.getLogger("uvicorn.error")
+
+
+class AutoFetcher:
+    def __init__(
+        self,
+        index,
+        store: ResourceStore,
+        fs: TargetFileSystem,
+        interval: float,
+        max_results: int = 1000,
+    ):
+        self.index = index
+        self.store = store
+        self.fs = fs
+        self.interval = interval
+        self.max_results = max_results
+        self.lock = Lock()
+        self.running = False
+        self.stopped = Event()
+
+    def schedule(self):
+        with self.lock:
+            if self.running:
+                return
+            self.running = True
+        Thread(target=self._run, name="Fido-Autofetch", daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def _run(self):
+        try:
+            feeds = [d["__uuid__"] for d in self.store.all() if d.get("autofetch")]
+            if len(feeds) == 0:
+                return
+            # No wait after the last feed, so the round ends before the next tick
+            spacing = self.interval / len(feeds)
+            for i, uuid in enumerate(feeds):
+                if self.stopped.is_set():
+                    return
+                started = time()
+                try:
+                    self.check(uuid)
+                except:
+                    log.exception(f"Autofetch check for saved podcast {uuid} failed")
+                if i < len(feeds) - 1:
+                    self.stopped.wait(max(spacing - (time() - started), 0))
+        finally:
+            with self.lock:
+                self.running = False
+
+    def check(self, uuid: str) -> list[dict]:
+        cast = Podcast.from_store(self.store, uuid)
+        if not cast or not cast.autofetch:
+            return []
+        since = cast.last_seen if cast.last_seen != None else int(time())
+        items = self.index.episodesByFeedId(
+            cast.id, since=since, max_results=self.max_results
+        )["items"]
+
+        # Podcasts saved before autofetch existed may still have fetched = null
+        previous = cast.fetched or []
+        fetched = set(str(f) for f in previous)
+        episodes = [
+            PodcastEpisode.from_api_item(e)
+            for e in items
+            if not str(e["id"]) in fetched and e["enclosureUrl"]
+        ]
+        last_seen = max([since] + [e["datePublished"] or 0 for e in items])
+        records = []
+        if len(episodes) > 0:
+            records = self.fs.download(
+                safe_name(cast.title),
+                resources=episodes,
+                names=[e.download_name() for e in episodes],
+            )
+            log.info(f"Autofetch queued {len(episodes)} new episodes of {cast.title}")
+
+        self.store.update(
+            uuid,
+            {
+                "fetched": previous + [str(e.id) for e in episodes],
+                "last_seen": last_seen,
+            },
+        )
+        return records
@@ -0,0 +1,137 @@
+from datetime import datetime, time
+from threading import Lock
+from time import monotonic, sleep
+
+from .cfg import cfg
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float = None):
+        self.lock = Lock()
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate: float, burst: float = None):
+        with self.lock:
+            self.rate = rate or 0
+            self.burst = burst if burst else self.rate
+            self.tokens = self.burst
+            self.updated = monotonic()
+
+    def reserve(self, n: int) -> float:
+        if self.rate <= 0:
+            return 0
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= n
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+
+class BandwidthShaper:
+    def __init__(
+        self,
+        limit: float = 0,
+        hosts: dict[str, float] = {},
+        per_host: float = 0,
+        schedule: list[dict] = [],
+    ):
+        self.lock = Lock()
+        self.bucket = TokenBucket(0)
+        self.host_buckets: dict[str, TokenBucket] = {}
+        self.configure(limit=limit, hosts=hosts, per_host=per_host, schedule=schedule)
+
+    def configure(
+        self,
+        limit: float = None,
+        hosts: dict[str, float] = None,
+        per_host: float = None,
+        schedule: list[dict] = None,
+    ):
+        windows = self.parse_schedule(schedule) if schedule != None else None
+        with self.lock:
+            if limit != None:
+                self.limit = limit
+            if hosts != None:
+                self.hosts = dict(hosts)
+            if per_host != None:
+                self.per_host = per_host
+            if schedule != None:
+                self.schedule = list(schedule)
+                self.windows = windows
+            self.host_buckets = {}
+            self._checked = 0
+            self._apply_schedule()
+
+    def settings(self) -> dict:
+        with self.lock:
+            return {
+                "limit": self.limit,
+                "hosts": self.hosts,
+                "per_host": self.per_host,
+                "schedule": self.schedule,
+                "effective_limit": self.bucket.rate,
+            }
+
+    @staticmethod
+    def _parse_time(value: str) -> time:
+        # strptime accepts single-digit hours ("6:00"), unlike time.fromisoformat
+        try:
+            return datetime.strptime(value, "%H:%M").time()
+        except ValueError:
+            return datetime.strptime(value, "%H:%M:%S").time()
+
+    @staticmethod
+    def parse_schedule(schedule: list[dict]) -> list[tuple[time, time, float]]:
+        windows = []
+        for window in schedule:
+            try:
+                windows.append(
+                    (
+                        BandwidthShaper._parse_time(window["start"]),
+                        BandwidthShaper._parse_time(window["end"]),
+                        window.get("limit", 0),
+                    )
+                )
+            except (KeyError, TypeError, ValueError):
+                raise ValueError(
+                    f"Invalid schedule window {window}, expected HH:MM start and end times"
+                ) from None
+        return windows
+
+    def _scheduled_limit(self) -> float:
+        now = datetime.now().time()
+        for start, end, limit in self.windows:
+            inside = start <= now < end if start <= end else now >= start or now < end
+            if inside:
+                return limit
+        return self.limit
+
+    def _apply_schedule(self):
+        rate = self._scheduled_limit()
+        if rate != self.bucket.rate:
+            self.bucket.set_rate(rate)
+
+    def _host_bucket(self, host: str) -> TokenBucket:
+        bucket = self.host_buckets.get(host)
+        if bucket == None:
+            with self.lock:
+                bucket = self.host_buckets.setdefault(
+                    host, TokenBucket(self.hosts.get(host, self.per_host))
+                )
+        return bucket
+
+    def throttle(self, host: str | None, n: int):
+        now = monotonic()
+        if self.schedule and now - self._checked > 1:
+            self._checked = now
+            with self.lock:
+                self._apply_schedule()
+        wait = self.bucket.reserve(n)
+        if host and (self.per_host or host in self.hosts.keys()):
+            wait = max(wait, self._host_bucket(host).reserve(n))
+        if wait > 0:
+            sleep(wait)
+
+
+shaper = BandwidthShaper(**cfg().get("bandwidth", {}))
@@ -0,0 +1,171 @@
+from collections import OrderedDict
+from itertools import count
+from threading import Event, Lock
+import secrets
+from time import monotonic, perf_counter
+from typing import Any, Callable
+
+from .metrics import INDEX_DURATION, INDEX_ERRORS
+
+
+class _Flight:
+    def __init__(self):
+        self.done = Event()
+        self.value = None
+        self.stamp = None
+        self.error: BaseException = None
+
+
+class TTLCache:
+    def __init__(self, maxsize: int = 512):
+        self.maxsize = maxsize
+        self.lock = Lock()
+        self.entries: OrderedDict[Any, tuple[float, Any, str]] = OrderedDict()
+        self.inflight: dict[Any, _Flight] = {}
+        self.instance = secrets.token_hex(4)
+        self.loads = count(1)
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get_or_load(self, key, ttl: float, loader: Callable[[], Any]):
+        return self.get_entry(key, ttl, loader)[0]
+
+    def stamp(self, key) -> str | None:
+        with self.lock:
+            if key in self.entries.keys():
+                expires, value, stamp = self.entries[key]
+                if expires > monotonic():
+                    return stamp
+        return None
+
+    def get_entry(self, key, ttl: float, loader: Callable[[], Any]) -> tuple[Any, str]:
+        with self.lock:
+            if key in self.entries.keys():
+                expires, value, stamp = self.entries[key]
+                if expires > monotonic():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value, stamp
+                del self.entries[key]
+
+            if key in self.inflight.keys():
+                flight = self.inflight[key]
+                self.coalesced += 1
+                leader = False
+            else:
+                flight = _Flight()
+                self.inflight[key] = flight
+                self.misses += 1
+                leader = True
+
+        if not leader:
+            flight.done.wait()
+            if flight.error:
+                raise flight.error
+            return flight.value, flight.stamp
+
+        try:
+            flight.value = loader()
+        except BaseException as e:
+            flight.error = e
+            raise
+        else:
+            flight.stamp = f"{self.instance}.{next(self.loads)}"
+            with self.lock:
+                self.entries[key] = (monotonic() + ttl, flight.value, flight.stamp)
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.maxsize:
+                    self.entries.popitem(last=False)
+            return flight.value, flight.stamp
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            flight.done.set()
+
+    def invalidate(self, key=None):
+        with self.lock:
+            if key == None:
+                self.entries.clear()
+            elif key in self.entries.keys():
+                del self.entries[key]
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+            }
+
+
+class CachedIndex:
+    DEFAULT_TTLS = {"search": 300, "podcastByFeedId": 3600, "episodesByFeedId": 600}
+
+    def __init__(self, index, maxsize: int = 512, ttl: dict[str, float] = {}):
+        self.index = index
+        self.ttls = {**self.DEFAULT_TTLS, **ttl}
+        self.cache = TTLCache(maxsize=maxsize)
+
+    def __getattr__(self, name: str):
+        target = getattr(self.index, name)
+        if not callable(target):
+            return target
+        method = self._method(name, target)
+        if not self._cached(name):
+            return method
+
+        def cached(*args, **kwargs):
+            return self.cache.get_or_load(
+                self._key(name, args, kwargs),
+                self.ttls[name],
+                lambda: method(*args, **kwargs),
+            )
+
+        cached.__name__ = name
+        return cached
+
+    def _method(self, name: str, target: Callable):
+        def method(*args, **kwargs):
+            started = perf_counter()
+            try:
+                return target(*args, **kwargs)
+            except Exception as e:
+                INDEX_ERRORS.inc(1, name, type(e).__name__)
+                raise
+            finally:
+                INDEX_DURATION.observe(perf_counter() - started, name)
+
+        method.__name__ = name
+        return method
+
+    def _key(self, name: str, args: tuple, kwargs: dict):
+        return (name, args, tuple(sorted(kwargs.items())))
+
+    def _cached(self, name: str) -> bool:
+        return name in self.ttls.keys() and self.ttls[name] > 0
+
+    def version(self, name: str, *args, **kwargs) -> str | None:
+        if not self._cached(name):
+            return None
+        return self.cache.stamp(self._key(name, args, kwargs))
+
+    def versioned(self, name: str) -> Callable[..., tuple[Any, str | None]]:
+        method = self._method(name, getattr(self.index, name))
+
+        def versioned(*args, **kwargs):
+            if not self._cached(name):
+                return method(*args, **kwargs), None
+            return self.cache.get_entry(
+                self._key(name, args, kwargs),
+                self.ttls[name],
+                lambda: method(*args, **kwargs),
+            )
+
+        versioned.__name__ = name
+        return versioned
+
+    def stats(self):
+        return self.cache.stats()
@@ -0,0 +1,63 @@
+import sqlite3
+from threading import RLock
+from time import time
+
+from .metrics import DB_DURATION, timed
+
+
+class DownloadCatalog:
+    def __init__(self, path: str):
+        self.lock = RLock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("PRAGMA busy_timeout=5000")
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS media (
+                path TEXT PRIMARY KEY,
+                url TEXT,
+                size INTEGER,
+                sha256 TEXT,
+                completedTimestamp REAL
+            )"""
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS media_url ON media (url)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS media_sha256 ON media (sha256)")
+
+    def _rows(self, query: str, params: list) -> list[dict]:
+        with self.lock:
+            cursor = self.db.execute(query, params)
+            columns = [c[0] for c in cursor.description]
+            return [dict(zip(columns, r)) for r in cursor.fetchall()]
+
+    @timed(DB_DURATION, "catalog", "get")
+    def get(self, path: str) -> dict | None:
+        rows = self._rows("SELECT * FROM media WHERE path = ?", [path])
+        return rows[0] if len(rows) > 0 else None
+
+    @timed(DB_DURATION, "catalog", "by_url")
+    def by_url(self, url: str) -> list[dict]:
+        return self._rows(
+            "SELECT * FROM media WHERE url = ? ORDER BY completedTimestamp DESC", [url]
+        )
+
+    @timed(DB_DURATION, "catalog", "by_hash")
+    def by_hash(self, sha256: str, size: int) -> list[dict]:
+        return self._rows(
+            "SELECT * FROM media WHERE sha256 = ? AND size = ? ORDER BY completedTimestamp",
+            [sha256, size],
+        )
+
+    @timed(DB_DURATION, "catalog", "record")
+    def record(self, path: str, url: str, size: int, sha256: str = None):
+        with self.lock:
+            with self.db:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO media (path, url, size, sha256, completedTimestamp) VALUES (?, ?, ?, ?, ?)",
+                    [path, url, size, sha256, time()],
+                )
+
+    def forget(self, path: str):
+        with self.lock:
+            with self.db:
+                self.db.execute("DELETE FROM media WHERE path = ?", [path])
@@ -1,4 +1,12 @@
 import os, json
 
+# Parsed once per RAW_CONFIG value and shared by every caller, so copy a
+# section (dict(cfg().get(...))) before changing it
+_parsed = {"raw": None, "value": None}
+
 def cfg():
-    return json.loads(os.environ["RAW_CONFIG"])
\ No newline at end of file
+    raw = os.environ["RAW_CONFIG"]
+    if raw != _parsed["raw"]:
+        _parsed["value"] = json.loads(raw)
+        _parsed["raw"] = raw
+    return _parsed["value"]
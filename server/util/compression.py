@@ -0,0 +1,244 @@
+import zlib
+
+from .aio import offload
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSIBLE = [
+    b"application/json",
+    b"application/x-ndjson",
+    b"application/xml",
+    b"text/",
+]
+# Compressor buffering would hold back events
+SKIP_TYPES = [b"text/event-stream"]
+SKIP_STATUS = [204, 206, 304]
+
+
+class _Zlib:
+    def __init__(self, level: int):
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressor.compress(data)
+
+    def sync(self) -> bytes:
+        return self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self.compressor.flush()
+
+
+class _Brotli:
+    def __init__(self, level: int):
+        self.compressor = brotli.Compressor(quality=min(level, 11))
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressor.process(data)
+
+    def sync(self) -> bytes:
+        return self.compressor.flush()
+
+    def finish(self) -> bytes:
+        return self.compressor.finish()
+
+
+class _Zstd:
+    def __init__(self, level: int):
+        self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressor.compress(data)
+
+    def sync(self) -> bytes:
+        return self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self) -> bytes:
+        return self.compressor.flush()
+
+
+# Preferred first when the client weighs codecs equally
+CODECS = {}
+if zstandard:
+    CODECS["zstd"] = _Zstd
+if brotli:
+    CODECS["br"] = _Brotli
+CODECS["gzip"] = _Zlib
+
+# Every suffix an ETag can carry, whether or not the codec is installed here
+TAG_SUFFIXES = ["zstd", "br", "gzip"]
+
+
+def parse_tags(value: str) -> list[str]:
+    # Compressed variants carry a codec suffix, see _encoded_tag
+    tags = []
+    for tag in value.split(","):
+        tag = tag.strip().removeprefix("W/")
+        for codec in TAG_SUFFIXES:
+            if tag.endswith(f'-{codec}"'):
+                tag = tag[: -len(codec) - 2] + '"'
+                break
+        tags.append(tag)
+    return tags
+
+
+def negotiate(accept: str) -> str | None:
+    weights = {}
+    for part in accept.split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0
+        weights[name.strip().lower()] = q
+    best, best_q = None, 0
+    for codec in CODECS.keys():
+        q = weights.get(codec, weights.get("*", 0))
+        if q > best_q:
+            best, best_q = codec, q
+    return best
+
+
+class CompressionMiddleware:
+    def __init__(
+        self, app, min_size: int = 1024, level: int = 1, offload_size: int = 65536
+    ):
+        self.app = app
+        self.min_size = min_size
+        self.level = level
+        self.offload_size = offload_size
+
+    async def _compress(self, compressor, data: bytes, last: bool) -> bytes:
+        # zlib and friends release the GIL, so large bodies compress off the loop
+        if len(data) >= self.offload_size:
+            return await offload("compress", _run, compressor, data, last)
+        return _run(compressor, data, last)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        accept, validators = "", b""
+        for name, value in scope["headers"]:
+            if name == b"accept-encoding":
+                accept = value.decode("latin-1")
+            elif name == b"if-none-match":
+                validators = value
+        codec = negotiate(accept) if accept else None
+        state = {"start": None, "compressor": None, "passthrough": False}
+
+        async def send_wrapper(message):
+            if state["passthrough"]:
+                return await send(message)
+
+            if message["type"] == "http.response.start":
+                if message["status"] == 304 and codec != None:
+                    message["headers"] = _revalidated_headers(
+                        message.get("headers", []), codec, validators
+                    )
+                headers = dict(message.get("headers", []))
+                content_type = headers.get(b"content-type", b"")
+                if (
+                    message["status"] in SKIP_STATUS
+                    or b"content-encoding" in headers.keys()
+                    or not any(content_type.startswith(t) for t in COMPRESSIBLE)
+                    or any(content_type.startswith(t) for t in SKIP_TYPES)
+                ):
+                    state["passthrough"] = True
+                    return await send(message)
+                message["headers"] = [
+                    (k, v) for k, v in message.get("headers", []) if k != b"vary"
+                ] + [(b"vary", _vary(headers.get(b"vary")))]
+                if codec == None:
+                    state["passthrough"] = True
+                    return await send(message)
+                state["start"] = message
+                return
+
+            if message["type"] != "http.response.body":
+                # e.g. http.response.pathsend from FileResponse, which can't be compressed
+                if state["start"] != None:
+                    start, state["start"] = state["start"], None
+                    state["passthrough"] = True
+                    await send(start)
+                return await send(message)
+
+            body = message.get("body", b"")
+            more = message.get("more_body", False)
+            if state["start"] != None:
+                start, state["start"] = state["start"], None
+                if not more and len(body) < self.min_size:
+                    state["passthrough"] = True
+                    await send(start)
+                    return await send(message)
+                state["compressor"] = CODECS[codec](self.level)
+                data = await self._compress(state["compressor"], body, not more)
+                start["headers"] = _compressed_headers(
+                    start["headers"], codec, None if more else len(data)
+                )
+                await send(start)
+                return await send({**message, "body": data})
+
+            data = await self._compress(state["compressor"], body, not more)
+            if len(data) > 0 or not more:
+                await send({**message, "body": data})
+
+        await self.app(scope, receive, send_wrapper)
+
+
+def _run(compressor, data: bytes, last: bool) -> bytes:
+    # Streamed chunks are flushed so clients can decode each one as it arrives
+    if last:
+        return compressor.compress(data) + compressor.finish()
+    return compressor.compress(data) + compressor.sync()
+
+
+def _vary(existing: bytes | None) -> bytes:
+    if existing == None:
+        return b"Accept-Encoding"
+    if b"accept-encoding" in existing.lower():
+        return existing
+    return existing + b", Accept-Encoding"
+
+
+def _encoded_tag(value: bytes, codec: str) -> bytes:
+    # Strong validators must differ between encodings of the same data
+    if not value.endswith(b'"'):
+        return value
+    return value[:-1] + f"-{codec}".encode("latin-1") + b'"'
+
+
+def _revalidated_headers(headers: list, codec: str, validators: bytes) -> list:
+    # A 304 repeats the validator the client holds, which may be the encoded one
+    return [
+        (k, _encoded_tag(v, codec))
+        if k == b"etag" and _encoded_tag(v, codec) in validators
+        else (k, v)
+        for k, v in headers
+    ]
+
+
+def _compressed_headers(headers: list, codec: str, length: int | None) -> list:
+    result = []
+    for name, value in headers:
+        if name == b"content-length":
+            continue
+        if name == b"etag":
+            value = _encoded_tag(value, codec)
+        result.append((name, value))
+    result.append((b"content-encoding", codec.encode("latin-1")))
+    if length != None:
+        result.append((b"content-length", str(length).encode("latin-1")))
+    return result
@@ -1,15 +1,41 @@
 from argparse import ArgumentError
+import json
+from datetime import datetime
 from fsspec import AbstractFileSystem
+from fsspec.implementations.local import LocalFileSystem
 import importlib
+import logging
+import os
+import posixpath
 
-from more_itertools import unzip
-
-from .models import Resource
+from .models import Resource, _dump, _load
+from .cache import TTLCache
+from .catalog import DownloadCatalog
 from .cfg import cfg
-from tinydb import TinyDB, where
+from .http import get_http
+from .jobqueue import QueueRunner, get_queue
+from .metrics import DOWNLOADS, STORAGE_DURATION, timed
+from .progress import progress
+from .registry import shared
+from .scheduler import DownloadJob, get_scheduler
+from .staging import get_staging
+from .trackers import FINISHED_TYPES, make_tracker_store
 from time import time
 from hashlib import sha256
-from threading import Thread
+from functools import partial
+
+log = logging.getLogger("uvicorn.error")
+_listings = TTLCache(maxsize=cfg().get("listing_cache", {}).get("maxsize", 256))
+
+
+def modified_time(info: dict) -> float | None:
+    for key in ["mtime", "LastModified", "last_modified", "modified", "created"]:
+        value = info.get(key)
+        if isinstance(value, datetime):
+            return value.timestamp()
+        if isinstance(value, (int, float)):
+            return float(value)
+    return None
 
 
 class TargetFileSystem:
@@ -26,108 +52,394 @@ class TargetFileSystem:
         self.args = args
         self.kwargs = kwargs
         self.root_path = root_path
-        self.db = TinyDB(cfg()["db_downloads"])
-        self.locked = False
+        tracker_options = cfg().get("download_tracker", {})
+        self.queue = get_queue()
+        if self.queue and tracker_options.get("backend", "tinydb") != "sqlite":
+            raise RuntimeError(
+                "shared_queue requires the sqlite download_tracker backend"
+            )
+        self.db = shared(
+            "trackers",
+            cfg()["db_downloads"],
+            lambda: make_tracker_store(cfg()["db_downloads"], **tracker_options),
+        )
+        catalog_path = cfg().get(
+            "download_catalog",
+            os.path.splitext(cfg()["db_downloads"])[0] + ".catalog.sqlite",
+        )
+        self.catalog = shared(
+            "catalog", catalog_path, lambda: DownloadCatalog(catalog_path)
+        )
+
+        self.interface: AbstractFileSystem = shared(
+            "interface",
+            (module, subclass, json.dumps([args, kwargs], sort_keys=True, default=str)),
+            lambda: getattr(
+                importlib.import_module(f"fsspec.implementations.{self.module}"),
+                self.subclass,
+            )(*args, **kwargs),
+        )
+        self.staging = None if self.is_local else get_staging()
+        if self.staging:
+            shared("staging-recovery", self.staging.root, self._recover_staged)
+        if self.queue:
+            progress.share(self.queue)
+            shared(
+                "runner",
+                id(self.queue),
+                lambda: QueueRunner(self.queue, get_scheduler(), self._build_job),
+            )
 
-        self.interface: AbstractFileSystem = getattr(
-            importlib.import_module(f"fsspec.implementations.{self.module}"),
-            self.subclass,
-        )(*args, **kwargs)
+    @property
+    def is_local(self):
+        return isinstance(self.interface, LocalFileSystem)
 
-    def wait_lock(self):
-        while self.locked:
-            pass
+    def transfer_options(self):
+        http = get_http()
+        segmented = cfg().get("segmented", {})
+        return {
+            "chunk_size": http.chunk_size,
+            "block_size": 0 if self.is_local or self.staging else http.remote_block_size,
+            "segments": segmented.get("segments", 1),
+            "segment_min_size": segmented.get("min_size", 104857600),
+            "segment_retries": segmented.get("retries", 3),
+        }
 
     def _path(self, path: str):
         return self.root_path.rstrip("/") + "/" + path
 
+    @timed(STORAGE_DURATION, "open")
     def open(self, path: str, **kwargs):
         return self.interface.open(self._path(path), **kwargs)
 
     def walk(self, path: str, **kwargs):
         return self.interface.walk(self._path(path), **kwargs)
 
+    @timed(STORAGE_DURATION, "ls")
     def ls(self, path: str, **kwargs):
         return self.interface.ls(self._path(path), **kwargs)
 
+    @timed(STORAGE_DURATION, "makedirs")
     def makedirs(self, path: str, exist_ok=False):
         return self.interface.makedirs(self._path(path), exist_ok=exist_ok)
     
+    @timed(STORAGE_DURATION, "exists")
     def exists(self, path: str, **kwargs):
         return self.interface.exists(self._path(path), **kwargs)
     
+    @timed(STORAGE_DURATION, "isdir")
     def isdir(self, path: str):
         return self.interface.isdir(self._path(path))
 
+    @timed(STORAGE_DURATION, "info")
+    def info(self, path: str, **kwargs):
+        return self.interface.info(self._path(path), **kwargs)
+
+    def _listing_key(self, path: str):
+        return (self.module, self.subclass, posixpath.normpath(self._path(path)))
+
+    def listing(self, path: str) -> list[dict]:
+        def load():
+            items = [
+                {
+                    "path": i["name"].rstrip("/").rsplit("/", maxsplit=1)[-1],
+                    "is_directory": i["type"] == "directory",
+                    "size": i.get("size"),
+                    "modified": modified_time(i),
+                }
+                for i in self.ls(path, detail=True)
+            ]
+            if self.staging:
+                names = set(i["path"] for i in items)
+                items += [i for i in self.staging.entries(path) if not i["path"] in names]
+            return items
+
+        return _listings.get_or_load(
+            self._listing_key(path),
+            cfg().get("listing_cache", {}).get("ttl", 5),
+            load,
+        )
+
+    def invalidate_listing(self, path: str):
+        _listings.invalidate(self._listing_key(path))
+        _listings.invalidate(self._listing_key(posixpath.dirname(path.rstrip("/"))))
+
     def _handle_download(
         self,
-        download: str,
-        id: str,
+        job: DownloadJob,
         container: str,
         name: str,
         resource: Resource,
         args=[],
         kwargs={},
     ):
-        self.wait_lock()
-        self.locked = True
-        self.db.update(
+        if job.cancelled.is_set():
+            return
+        self._status(
+            job,
             {
                 "type": "in_progress",
                 "startedTimestamp": time(),
                 "message": "Downloading...",
             },
-            (where("download_id") == download) & (where("item_id") == id),
         )
-        self.locked = False
-        with self.open(
-            f"{container}/{resource.download_pathprefix()}{name}", mode="wb"
-        ) as f:
-            success, result = resource.download(f, *args, **kwargs)
-
-        if success:
-            self.wait_lock()
-            self.locked = True
-            self.db.update(
-                {"type": "complete", "completedTimestamp": time(), "message": result},
-                (where("download_id") == download) & (where("item_id") == id),
+        path = f"{container}/{resource.download_pathprefix()}{name}"
+        try:
+            reused = self._reuse_existing(path, resource)
+        except Exception:
+            log.exception(f"Failed to check for existing copies of {path}")
+            reused = None
+        if reused:
+            self.invalidate_listing(container)
+            self._status(
+                job,
+                {"type": "skipped", "completedTimestamp": time(), "message": reused},
             )
-            self.locked = False
-        else:
-            self.wait_lock()
-            self.locked = True
-            self.db.update(
-                {"type": "error", "completedTimestamp": time(), "message": result},
-                (where("download_id") == download) & (where("item_id") == id),
+            return
+
+        options = self.transfer_options()
+        open_options = {} if self.is_local else {"block_size": options["block_size"]}
+        # Deduplicated local copies share an inode, so never truncate one in place
+        target = path + ".fido-part" if self.is_local else path
+        try:
+            if self.staging:
+                f = self.staging.open(path)
+            else:
+                f = self.open(target, mode="wb", **open_options)
+            with f:
+                success, result = resource.download(
+                    f,
+                    *args,
+                    cancel=job.cancelled,
+                    progress=progress.tracker(job.download_id, job.item_id),
+                    **{**options, **kwargs},
+                )
+        except Exception as e:
+            success, result = False, {"result": "failure", "error": str(e)}
+
+        if self.staging:
+            if success and not job.cancelled.is_set():
+                self.staging.commit(path)
+                self.invalidate_listing(container)
+                self._status(job, {"type": "staged", "message": result})
+                self._upload_staged(job, container, path, resource, result)
+                return
+            self.staging.discard(path)
+
+        if self.is_local:
+            if success and not job.cancelled.is_set():
+                os.replace(self._path(target), self._path(path))
+            elif os.path.exists(self._path(target)):
+                os.remove(self._path(target))
+
+        self.invalidate_listing(container)
+        if job.cancelled.is_set():
+            if not self.staging and not self.is_local and self.exists(path):
+                self.interface.rm(self._path(path))
+            self._cancel_tracker(job)
+            return
+
+        if success and resource.download_key():
+            self.catalog.record(
+                path,
+                resource.download_key(),
+                result.get("total_size"),
+                result.get("sha256"),
             )
-            self.locked = False
+            if self.is_local and result.get("sha256"):
+                source = self._deduplicate(path, result["sha256"], result["total_size"])
+                if source:
+                    result["deduplicated"] = source
 
-    def download_process(
-        self, did_map, resources, args, kwargs, download_id, container
+        self._status(
+            job,
+            {
+                "type": "complete" if success else "error",
+                "completedTimestamp": time(),
+                "message": result,
+            },
+        )
+
+    def _upload_staged(
+        self,
+        job: DownloadJob,
+        container: str,
+        path: str,
+        resource: Resource,
+        result: dict,
     ):
-        ids, _names = unzip(did_map.items())
-        threads = {}
-        for resource, did, name, arg, kwarg in zip(
-            resources, ids, _names, args, kwargs
-        ):
-            args = [download_id, did, container, name, resource]
-            args.extend(arg)
-            t = Thread(
-                target=self._handle_download,
+        def started(attempt: int):
+            self._status(
+                job,
+                {
+                    "type": "uploading",
+                    "message": {**result, "attempt": attempt + 1},
+                },
+            )
+
+        def finished(error: Exception | None):
+            self.invalidate_listing(container)
+            if error == None and resource.download_key():
+                self.catalog.record(
+                    path,
+                    resource.download_key(),
+                    result.get("total_size"),
+                    result.get("sha256"),
+                )
+            self._status(
+                job,
+                {
+                    "type": "complete" if error == None else "error",
+                    "completedTimestamp": time(),
+                    "message": result
+                    if error == None
+                    else {**result, "result": "failure", "error": str(error)},
+                },
+            )
+
+        self.staging.upload(path, partial(self._put, path), started, finished)
+
+    @timed(STORAGE_DURATION, "put")
+    def _put(self, path: str, local: str):
+        self.interface.put_file(local, self._path(path))
+
+    def _recover_staged(self):
+        def finished(path: str, error: Exception | None):
+            self.invalidate_listing(posixpath.dirname(path))
+            if error != None:
+                log.error(f"Failed to upload recovered staged file {path}: {error}")
+
+        paths = self.staging.recover()
+        for path in paths:
+            self.staging.upload(
+                path, partial(self._put, path), lambda attempt: None, partial(finished, path)
+            )
+        if len(paths) > 0:
+            log.info(f"Re-queued {len(paths)} staged files for upload")
+        return paths
+
+    def staged_info(self, path: str) -> dict | None:
+        return self.staging.info(path) if self.staging else None
+
+    def _size(self, path: str) -> int | None:
+        try:
+            return self.info(path)["size"]
+        except FileNotFoundError:
+            return None
+
+    @timed(STORAGE_DURATION, "link")
+    def _link(self, source: str, path: str):
+        if self.is_local:
+            temp = self._path(path) + ".fido-link"
+            try:
+                os.link(self._path(source), temp)
+                os.replace(temp, self._path(path))
+                return "linked"
+            except OSError:
+                pass
+        self.interface.cp_file(self._path(source), self._path(path))
+        return "copied"
+
+    def _reuse_existing(self, path: str, resource: Resource) -> dict | None:
+        key = resource.download_key()
+        if key == None:
+            return None
+
+        entry = self.catalog.get(path)
+        if entry and entry["url"] == key and self._size(path) == entry["size"]:
+            return {"result": "skipped", "reason": "exists", "total_size": entry["size"]}
+
+        for other in self.catalog.by_url(key):
+            if other["path"] != path and self._size(other["path"]) == other["size"]:
+                reason = self._link(other["path"], path)
+                self.catalog.record(path, key, other["size"], other["sha256"])
+                return {
+                    "result": "skipped",
+                    "reason": reason,
+                    "source": other["path"],
+                    "total_size": other["size"],
+                }
+
+        size = self._size(path)
+        if entry == None and size != None and size == resource.download_size():
+            self.catalog.record(path, key, size)
+            return {"result": "skipped", "reason": "exists", "total_size": size}
+        return None
+
+    def _deduplicate(self, path: str, sha256: str, size: int) -> str | None:
+        for other in self.catalog.by_hash(sha256, size):
+            if other["path"] != path and self._size(other["path"]) == size:
+                self._link(other["path"], path)
+                return other["path"]
+        return None
+
+    def _status(self, job: DownloadJob, fields: dict):
+        self.db.update(job.download_id, job.item_id, fields)
+        progress.set_state(job.download_id, job.item_id, fields["type"])
+        if fields["type"] in FINISHED_TYPES:
+            DOWNLOADS.inc(1, fields["type"])
+            if self.queue:
+                self.queue.wake.set()
+
+    def _cancel_tracker(self, job: DownloadJob):
+        self._status(
+            job,
+            {"type": "cancelled", "completedTimestamp": time(), "message": "Cancelled"},
+        )
+
+    def _job(
+        self,
+        download_id: str,
+        item_id: str,
+        container: str,
+        name: str,
+        resource: Resource,
+        args: list,
+        kwargs: dict,
+        priority: int,
+    ):
+        return DownloadJob(
+            download_id,
+            item_id,
+            partial(
+                self._handle_download,
+                container=container,
+                name=name,
+                resource=resource,
                 args=args,
-                kwargs=kwarg,
-                name="Fido-Download-Item-" + did,
+                kwargs=kwargs,
+            ),
+            on_cancel=self._cancel_tracker,
+            host=resource.download_host(),
+            priority=priority,
+        )
+
+    def _build_job(self, row: dict) -> DownloadJob | None:
+        payload = row["payload"]
+        try:
+            return self._job(
+                row["download_id"],
+                row["item_id"],
+                payload["container"],
+                payload["name"],
+                _load(payload["resource"]),
+                _load(payload["args"]),
+                _load(payload["kwargs"]),
+                row["priority"],
+            )
+        except Exception as e:
+            log.exception(
+                f"Failed to load queued download {row['download_id']}/{row['item_id']}"
             )
-            t.start()
-            threads[did] = t
-            if len(threads.keys()) > 4:
-                while len(threads.keys()) > 4:
-                    td = []
-                    for k, v in threads.items():
-                        if not v.is_alive():
-                            td.append(k)
-                    for k in td:
-                        del threads[k]
+            self._status(
+                DownloadJob(row["download_id"], row["item_id"], None),
+                {
+                    "type": "error",
+                    "completedTimestamp": time(),
+                    "message": {"result": "failure", "error": str(e)},
+                },
+            )
+            return None
 
     def download(
         self,
@@ -136,27 +448,37 @@ class TargetFileSystem:
         names: list[str] = [],
         args: list[list] = None,
         kwargs: list[dict] = None,
+        priority: int = 0,
+        containers: list[str] = None,
     ):
         if args == None:
             args = [[] for i in range(len(resources))]
         if kwargs == None:
             kwargs = [{} for i in range(len(resources))]
-        if not (len(names) == len(args) == len(kwargs) == len(resources)):
+        # Batches spanning several folders pass one container per resource
+        if containers == None:
+            containers = [container for i in range(len(resources))]
+        if not (
+            len(names) == len(args) == len(kwargs) == len(containers) == len(resources)
+        ):
             raise ArgumentError(
-                "resources, names, args, and kwargs must be the same length"
+                "resources, names, args, kwargs, and containers must be the same length"
             )
-        self.makedirs(container, exist_ok=True)
+        for folder in dict.fromkeys(containers or [container]):
+            self.makedirs(folder, exist_ok=True)
+            self.invalidate_listing(folder)
         download_id = sha256(str(time()).encode("utf-8")).hexdigest()
-        did_map = {}
-        for name in names:
-            download_item_id = sha256(str(time()).encode("utf-8")).hexdigest()[:12]
-            did_map[download_item_id] = name
-            self.wait_lock()
-            self.locked = True
-            self.db.insert(
+        records = []
+        for index, (resource, name, container) in enumerate(
+            zip(resources, names, containers)
+        ):
+            download_item_id = sha256(
+                f"{time()}:{index}:{name}".encode("utf-8")
+            ).hexdigest()[:12]
+            records.append(
                 {
                     "type": "queued",
-                    "path": f"{container}/{name}",
+                    "path": f"{container}/{resource.download_pathprefix()}{name}",
                     "startedTimestamp": None,
                     "completedTimestamp": None,
                     "message": "Queued",
@@ -165,19 +487,77 @@ class TargetFileSystem:
                     "item_id": download_item_id,
                 }
             )
-            self.locked = False
+        self.db.insert_many(records)
 
-        proc = Thread(
-            target=self.download_process,
-            name=f"Fido-Downloader-{download_id}",
-            args=[did_map, resources, args, kwargs, download_id, container],
-        )
-        proc.start()
+        items = list(zip(records, resources, names, args, kwargs))
+        if self.queue:
+            self.queue.push(
+                [
+                    {
+                        "download_id": download_id,
+                        "item_id": record["item_id"],
+                        "priority": priority,
+                        "host": resource.download_host(),
+                        "payload": {
+                            "container": record["container"],
+                            "name": name,
+                            "resource": _dump(resource),
+                            "args": _dump(arg),
+                            "kwargs": _dump(kwarg),
+                        },
+                    }
+                    for record, resource, name, arg, kwarg in items
+                ]
+            )
+        else:
+            progress.register(download_id, [r["item_id"] for r in records])
+            get_scheduler().submit(
+                [
+                    self._job(
+                        download_id,
+                        record["item_id"],
+                        record["container"],
+                        name,
+                        resource,
+                        arg,
+                        kwarg,
+                        priority,
+                    )
+                    for record, resource, name, arg, kwarg in items
+                ]
+            )
+
+        return self.db.search(download_id)
+
+    def cancel_download(self, download_id: str, item_id: str = None):
+        cancelled = get_scheduler().cancel(download_id, item_id=item_id)
+        if self.queue:
+            queued, claimed = self.queue.cancel(download_id, item_id=item_id)
+            for iid in queued:
+                self._cancel_tracker(DownloadJob(download_id, iid, None))
+            cancelled = list(dict.fromkeys(cancelled + queued + claimed))
+        return cancelled
 
-        return self.db.search(where("download_id") == download_id)
+    def download_status(self, download_id: str):
+        return self.db.search(download_id)
+
+    def download_summary(self, download_id: str):
+        return self.db.summary(download_id)
+
+    def leader(self, name: str, ttl: float) -> bool:
+        return self.queue == None or self.queue.lease_held(name, ttl)
 
     def clear_old_download_trackers(self):
-        self.db.remove(
-            ((where("type") == "complete") | (where("type") == "error"))
-            & (where("completedTimestamp") < (time() - cfg()["download_entry_clear"]))
+        before = time() - cfg()["download_entry_clear"]
+        self.db.remove_finished(before)
+        if self.staging:
+            self._recover_staged()
+        self.db.remove_summaries(
+            time() - cfg().get("download_summary_clear", 30 * 86400)
         )
+        if self.queue:
+            self.queue.remove_finished(before)
+
+
+def get_target() -> TargetFileSystem:
+    return shared("target", "default", lambda: TargetFileSystem(**cfg()["target"]))
@@ -0,0 +1,50 @@
+from threading import Lock
+import requests
+from requests.adapters import HTTPAdapter
+
+from .cfg import cfg
+
+
+class HTTPPool:
+    def __init__(
+        self,
+        pool_connections: int = 16,
+        pool_maxsize: int = 16,
+        connect_timeout: float = 5,
+        read_timeout: float = 30,
+        chunk_size: int = 65536,
+        remote_block_size: int = 4194304,
+    ):
+        self.timeout = (connect_timeout, read_timeout)
+        self.chunk_size = chunk_size
+        self.remote_block_size = remote_block_size
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=pool_connections, pool_maxsize=pool_maxsize
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.get(url, **kwargs)
+
+    def head(self, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.head(url, **kwargs)
+
+
+_pool: HTTPPool = None
+_pool_lock = Lock()
+
+
+def get_http() -> HTTPPool:
+    global _pool
+    with _pool_lock:
+        if _pool == None:
+            options = dict(cfg().get("http", {}))
+            options.setdefault(
+                "pool_maxsize", max(16, cfg().get("download_workers", 4))
+            )
+            _pool = HTTPPool(**options)
+    return _pool
@@ -0,0 +1,314 @@
+import json
+import logging
+import os
+import socket
+import sqlite3
+from threading import Event, RLock, Thread
+from time import time
+from typing import Callable
+
+from .cfg import cfg
+from .metrics import DB_DURATION, gauge, timed
+from .registry import shared, shared_items
+from .trackers import FINISHED_TYPES
+
+log = logging.getLogger("uvicorn.error")
+
+
+class SharedQueue:
+    def __init__(self, path: str, lease: float = 60, poll: float = 0.5):
+        self.lock = RLock()
+        self.lease = lease
+        self.poll = poll
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("PRAGMA busy_timeout=5000")
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS jobs (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                download_id TEXT NOT NULL,
+                item_id TEXT NOT NULL,
+                priority INTEGER NOT NULL DEFAULT 0,
+                host TEXT,
+                payload TEXT NOT NULL,
+                state TEXT NOT NULL DEFAULT 'queued',
+                owner TEXT,
+                heartbeat REAL,
+                cancelled INTEGER NOT NULL DEFAULT 0,
+                type TEXT NOT NULL DEFAULT 'queued',
+                bytes INTEGER NOT NULL DEFAULT 0,
+                total INTEGER,
+                rate REAL NOT NULL DEFAULT 0,
+                eta REAL,
+                version INTEGER NOT NULL DEFAULT 0,
+                finished REAL,
+                UNIQUE (download_id, item_id)
+            )"""
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, priority)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_owner ON jobs (owner)")
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_finished ON jobs (state, finished)"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT, expires REAL)"
+        )
+        self.db.commit()
+        self.wake = Event()
+
+    @timed(DB_DURATION, "queue", "push")
+    def push(self, jobs: list[dict]):
+        with self.lock:
+            with self.db:
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO jobs (download_id, item_id, priority, host, payload) VALUES (?, ?, ?, ?, ?)",
+                    [
+                        (
+                            j["download_id"],
+                            j["item_id"],
+                            j["priority"],
+                            j["host"],
+                            json.dumps(j["payload"]),
+                        )
+                        for j in jobs
+                    ],
+                )
+        self.wake.set()
+
+    @timed(DB_DURATION, "queue", "claim")
+    def claim(self, limit: int, host_limit: int = 0) -> list[dict]:
+        if limit <= 0:
+            return []
+        now = time()
+        with self.lock:
+            with self.db:
+                self.db.execute("BEGIN IMMEDIATE")
+                self.db.execute(
+                    "UPDATE jobs SET state = 'queued', owner = NULL WHERE state = 'claimed' AND heartbeat < ?",
+                    [now - self.lease],
+                )
+                hosts = dict(
+                    self.db.execute(
+                        "SELECT host, COUNT(*) FROM jobs WHERE state = 'claimed' AND host IS NOT NULL GROUP BY host"
+                    ).fetchall()
+                )
+                candidates = self.db.execute(
+                    """SELECT seq, download_id, item_id, priority, host, payload FROM (
+                        SELECT *, ROW_NUMBER() OVER (PARTITION BY download_id ORDER BY seq) AS turn
+                        FROM jobs WHERE state = 'queued' AND cancelled = 0
+                    ) ORDER BY priority, turn, seq LIMIT ?""",
+                    [limit * 4 if host_limit > 0 else limit],
+                ).fetchall()
+                claimed = []
+                for seq, did, iid, priority, host, payload in candidates:
+                    if host_limit > 0 and host and hosts.get(host, 0) >= host_limit:
+                        continue
+                    if host:
+                        hosts[host] = hosts.get(host, 0) + 1
+                    claimed.append(
+                        {
+                            "seq": seq,
+                            "download_id": did,
+                            "item_id": iid,
+                            "priority": priority,
+                            "host": host,
+                            "payload": json.loads(payload),
+                        }
+                    )
+                    if len(claimed) >= limit:
+                        break
+                self.db.executemany(
+                    "UPDATE jobs SET state = 'claimed', owner = ?, heartbeat = ? WHERE seq = ?",
+                    [(self.owner, now, c["seq"]) for c in claimed],
+                )
+        return claimed
+
+    def heartbeat(self):
+        with self.lock:
+            with self.db:
+                self.db.execute(
+                    "UPDATE jobs SET heartbeat = ? WHERE owner = ? AND state = 'claimed'",
+                    [time(), self.owner],
+                )
+
+    def cancel(self, download_id: str, item_id: str = None) -> tuple[list[str], list[str]]:
+        query = "download_id = ?" + ("" if item_id == None else " AND item_id = ?")
+        params = [download_id] + ([] if item_id == None else [item_id])
+        with self.lock:
+            with self.db:
+                self.db.execute("BEGIN IMMEDIATE")
+                rows = self.db.execute(
+                    f"SELECT item_id, state FROM jobs WHERE {query} AND state != 'done' AND cancelled = 0",
+                    params,
+                ).fetchall()
+                self.db.execute(
+                    f"UPDATE jobs SET cancelled = 1 WHERE {query} AND state != 'done'",
+                    params,
+                )
+        return (
+            [i for i, state in rows if state == "queued"],
+            [i for i, state in rows if state == "claimed"],
+        )
+
+    def cancelled_claims(self) -> list[tuple[str, str]]:
+        with self.lock:
+            return self.db.execute(
+                "SELECT download_id, item_id FROM jobs WHERE owner = ? AND state = 'claimed' AND cancelled = 1",
+                [self.owner],
+            ).fetchall()
+
+    def set_state(self, download_id: str, item_id: str, state: str):
+        finished = state in FINISHED_TYPES
+        with self.lock:
+            with self.db:
+                self.db.execute(
+                    "UPDATE jobs SET type = ?, version = version + 1"
+                    + (", state = 'done', finished = ?, rate = 0, eta = NULL" if finished else "")
+                    + " WHERE download_id = ? AND item_id = ?",
+                    [state] + ([time()] if finished else []) + [download_id, item_id],
+                )
+
+    @timed(DB_DURATION, "queue", "publish")
+    def publish(self, download_id: str, item_id: str, item: dict):
+        with self.lock:
+            with self.db:
+                self.db.execute(
+                    "UPDATE jobs SET bytes = ?, total = ?, rate = ?, eta = ?, version = version + 1 WHERE download_id = ? AND item_id = ?",
+                    [
+                        item["bytes"],
+                        item["total"],
+                        item["rate"],
+                        item["eta"],
+                        download_id,
+                        item_id,
+                    ],
+                )
+
+    def version(self, download_id: str) -> int | None:
+        with self.lock:
+            count, version = self.db.execute(
+                "SELECT COUNT(*), SUM(version) FROM jobs WHERE download_id = ?",
+                [download_id],
+            ).fetchone()
+        return version if count > 0 else None
+
+    def snapshot(self, download_id: str) -> dict | None:
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT item_id, type, bytes, total, rate, eta FROM jobs WHERE download_id = ? ORDER BY seq",
+                [download_id],
+            ).fetchall()
+        if len(rows) == 0:
+            return None
+        items = [
+            dict(zip(["item_id", "type", "bytes", "total", "rate", "eta"], r))
+            for r in rows
+        ]
+        return {
+            "download_id": download_id,
+            "finished": all(i["type"] in FINISHED_TYPES for i in items),
+            "bytes": sum(i["bytes"] for i in items),
+            "total": sum(i["total"] or 0 for i in items),
+            "rate": round(sum(i["rate"] for i in items), 1),
+            "items": items,
+        }
+
+    def counts(self) -> dict[tuple, int]:
+        with self.lock:
+            return {
+                (state,): count
+                for state, count in self.db.execute(
+                    "SELECT state, COUNT(*) FROM jobs GROUP BY state"
+                )
+            }
+
+    def remove_finished(self, before: float) -> int:
+        with self.lock:
+            with self.db:
+                return self.db.execute(
+                    "DELETE FROM jobs WHERE state = 'done' AND finished < ?", [before]
+                ).rowcount
+
+    def lease_held(self, name: str, ttl: float) -> bool:
+        now = time()
+        with self.lock:
+            with self.db:
+                self.db.execute(
+                    """INSERT INTO leases (name, owner, expires) VALUES (?, ?, ?)
+                    ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires = excluded.expires
+                    WHERE leases.owner = excluded.owner OR leases.expires < ?""",
+                    [name, self.owner, now + ttl, now],
+                )
+                owner = self.db.execute(
+                    "SELECT owner FROM leases WHERE name = ?", [name]
+                ).fetchone()[0]
+        return owner == self.owner
+
+
+class QueueRunner:
+    def __init__(
+        self,
+        queue: SharedQueue,
+        scheduler,
+        build: Callable[[dict], object],
+    ):
+        self.queue = queue
+        self.scheduler = scheduler
+        self.build = build
+        self.stopped = Event()
+        self.thread = Thread(target=self._run, name="Fido-Queue-Runner", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.queue.wake.set()
+
+    def _run(self):
+        while not self.stopped.is_set():
+            try:
+                self.queue.heartbeat()
+                for download_id, item_id in self.queue.cancelled_claims():
+                    self.scheduler.cancel(download_id, item_id=item_id)
+                idle = self.scheduler.workers - self.scheduler.active - self.scheduler.queued
+                jobs = [
+                    self.build(row)
+                    for row in self.queue.claim(idle, self.scheduler.host_limit)
+                ]
+                jobs = [j for j in jobs if j != None]
+                if len(jobs) > 0:
+                    self.scheduler.submit(jobs)
+            except:
+                log.exception("Shared download queue poll failed")
+            self.queue.wake.wait(self.queue.poll)
+            self.queue.wake.clear()
+
+
+def _queue_counts():
+    queues = list(shared_items("queue").values())
+    return queues[0].counts() if len(queues) > 0 else None
+
+
+gauge(
+    "fido_shared_queue_jobs",
+    "Jobs in the cross-worker download queue by state",
+    _queue_counts,
+    ("state",),
+)
+
+
+def get_queue() -> SharedQueue | None:
+    options = cfg().get("shared_queue")
+    if not options:
+        return None
+    path = options.get(
+        "path", os.path.splitext(cfg()["db_downloads"])[0] + ".queue.sqlite"
+    )
+    return shared(
+        "queue",
+        path,
+        lambda: SharedQueue(
+            path, lease=options.get("lease", 60), poll=options.get("poll", 0.5)
+        ),
+    )
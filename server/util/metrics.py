@@ -0,0 +1,304 @@
+from bisect import bisect_left
+from functools import wraps
+import logging
+from threading import Lock
+from time import perf_counter
+from typing import Callable
+
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+)
+
+log = logging.getLogger("uvicorn.error")
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if len(pairs) > 0 else ""
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labels)
+        self.lock = Lock()
+
+    def header(self) -> list[str]:
+        return [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+
+    def render(self) -> list[str]:
+        raise NotImplementedError()
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, description, labels)
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, *labels):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> list[str]:
+        with self.lock:
+            values = list(self.values.items())
+        return self.header() + [
+            f"{self.name}{_labels(self.labelnames, k)} {v}" for k, v in values
+        ]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+        self.values: dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(labels)
+            if series == None:
+                series = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def time(self, *labels) -> "_Timer":
+        return _Timer(self, labels)
+
+    def render(self) -> list[str]:
+        with self.lock:
+            values = [(k, list(c), s) for k, (c, s) in self.values.items()]
+        lines = self.header()
+        for labels, counts, total in values:
+            running = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                running += count
+                le = f'le="{bound}"'
+                lines.append(
+                    f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {running}"
+                )
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {running}")
+        return lines
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        callback: Callable[[], float | dict[tuple, float]],
+        labels: tuple[str, ...] = (),
+        kind: str = "gauge",
+    ):
+        super().__init__(name, description, labels)
+        self.callback = callback
+        self.kind = kind
+
+    def render(self) -> list[str]:
+        value = self.callback()
+        if value == None:
+            return []
+        values = value.items() if isinstance(value, dict) else [((), value)]
+        return self.header() + [
+            f"{self.name}{_labels(self.labelnames, k)} {v}" for k, v in values
+        ]
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "started")
+
+    def __init__(self, histogram: Histogram, labels: tuple):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(perf_counter() - self.started, *self.labels)
+
+
+class Registry:
+    def __init__(self):
+        self.lock = Lock()
+        self.metrics: dict[str, Metric] = {}
+        self.broken: set[str] = set()
+
+    def register(self, metric: Metric) -> Metric:
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def render(self) -> str:
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception:
+                # Log once per failure streak rather than on every scrape
+                if not metric.name in self.broken:
+                    self.broken.add(metric.name)
+                    log.exception("Failed to render metric %s", metric.name)
+            else:
+                self.broken.discard(metric.name)
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, description: str, labels: tuple[str, ...] = ()) -> Counter:
+    return REGISTRY.register(Counter(name, description, labels))
+
+
+def histogram(
+    name: str,
+    description: str,
+    labels: tuple[str, ...] = (),
+    buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+) -> Histogram:
+    return REGISTRY.register(Histogram(name, description, labels, buckets))
+
+
+def gauge(
+    name: str,
+    description: str,
+    callback: Callable[[], float | dict[tuple, float]],
+    labels: tuple[str, ...] = (),
+    kind: str = "gauge",
+) -> Gauge:
+    return REGISTRY.register(Gauge(name, description, callback, labels, kind))
+
+
+def timed(metric: Histogram, *labels):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            started = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                metric.observe(perf_counter() - started, *labels)
+
+        return wrapper
+
+    return decorator
+
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        started = perf_counter()
+        state = {"status": 500, "bytes": 0}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                state["status"] = message["status"]
+            elif message["type"] == "http.response.body":
+                state["bytes"] += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            path = getattr(route, "path", None) or "unmatched"
+            HTTP_DURATION.observe(
+                perf_counter() - started, scope["method"], path, state["status"]
+            )
+            if state["bytes"] > 0:
+                HTTP_BYTES.inc(state["bytes"], path)
+
+
+HTTP_DURATION = histogram(
+    "fido_http_request_duration_seconds",
+    "Time spent serving HTTP requests, including streamed bodies",
+    ("method", "route", "status"),
+)
+HTTP_BYTES = counter(
+    "fido_http_response_bytes_total",
+    "Response body bytes sent to clients",
+    ("route",),
+)
+UPSTREAM_DURATION = histogram(
+    "fido_upstream_duration_seconds",
+    "Time spent in offloaded upstream calls, including executor wait",
+    ("upstream", "call"),
+)
+UPSTREAM_ERRORS = counter(
+    "fido_upstream_errors_total",
+    "Offloaded upstream calls that raised",
+    ("upstream", "call", "error"),
+)
+INDEX_DURATION = histogram(
+    "fido_index_request_duration_seconds",
+    "Podcast Index API request time, excluding cache hits",
+    ("method",),
+)
+INDEX_ERRORS = counter(
+    "fido_index_errors_total",
+    "Podcast Index API requests that failed",
+    ("method", "error"),
+)
+DOWNLOAD_BYTES = counter(
+    "fido_download_bytes_total", "Bytes pulled from remote media servers"
+)
+DOWNLOADS = counter(
+    "fido_downloads_total", "Finished download items by result", ("result",)
+)
+STORAGE_DURATION = histogram(
+    "fido_storage_op_duration_seconds",
+    "Target filesystem operation time",
+    ("op",),
+)
+DB_DURATION = histogram(
+    "fido_db_op_duration_seconds",
+    "Database operation time, including lock waits",
+    ("store", "op"),
+)
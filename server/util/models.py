@@ -1,113 +1,140 @@
-from inspect import isclass
+from inspect import Parameter, signature
 from io import FileIO
 import json
 from xmlrpc.client import boolean
 from tinydb import where
 from tinydb.table import Table
 from tinydb.queries import QueryLike
+from .bandwidth import shaper
+from .http import get_http
+from .progress import ProgressTracker
+from .segments import fetch_segmented
+from .store import ResourceStore
 import random, hashlib
-import requests
+from threading import Event
+from urllib.parse import urlparse
+import mimetypes
+from requests.exceptions import RequestException
+import posixpath
+import string
+
+RESOURCES: dict[str, type["Resource"]] = {}
+PRIMITIVES = frozenset([str, int, float, bool, type(None)])
+
+
+def safe_name(name: str) -> str:
+    return "".join(
+        [
+            (
+                i
+                if i in string.ascii_letters
+                or i in string.digits
+                or i in "_ (){}[]+-,:;<>=#&!$%"
+                else "-"
+            )
+            for i in name
+        ]
+    )
+
+
+def _new_uuid():
+    return hashlib.sha256(str(random.random()).encode("utf-8")).hexdigest()[:12]
+
+
+def _dump(value):
+    if isinstance(value, Resource):
+        return value.to_dict()
+    if type(value) == dict:
+        return {k: v if type(v) in PRIMITIVES else _dump(v) for k, v in value.items()}
+    if type(value) in (list, tuple):
+        return [v if type(v) in PRIMITIVES else _dump(v) for v in value]
+    return value
+
+
+def _load(value):
+    if type(value) == dict:
+        if value.get("__rid__") in RESOURCES.keys():
+            return RESOURCES[value["__rid__"]].from_raw(value)
+        return {k: v if type(v) in PRIMITIVES else _load(v) for k, v in value.items()}
+    if type(value) == list:
+        return [v if type(v) in PRIMITIVES else _load(v) for v in value]
+    return value
 
 
 class Resource:
-    def __init__(self, uuid: str = None, **kwargs):
-        self.__raw__ = kwargs
-        self.__exclude__ = []
-        self.__rid__ = "Resource"
-        self.__uuid__ = (
-            uuid
-            if uuid
-            else hashlib.sha256(str(random.random()).encode("utf-8")).hexdigest()[:12]
-        )
+    __slots__ = ("__uuid__",)
+    __fields__: tuple[str, ...] = ()
+    __exclude__: tuple[str, ...] = ()
+    __rid__ = "Resource"
 
-    @classmethod
-    def _parse_dict(cls, dct: dict):
-        ret = {}
-        for k, v in dct.items():
-            if k == "__rid__":
-                continue
-            if k == "__uuid__":
-                ret["uuid"] = v
-                continue
-            if type(v) == dict:
-                if "__rid__" in v.keys():
-                    if v["__rid__"] in globals().keys() and issubclass(
-                        globals()[v["__rid__"]], Resource
-                    ):
-                        del v["__rid__"]
-                        ret[k] = globals()[v["__rid__"]].from_raw(v)
-                        continue
-                ret[k] = cls._parse_dict(v)
-            elif type(v) == list:
-                ret[k] = cls._parse_list(v)
-            else:
-                ret[k] = v
-        return ret
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.__rid__ = cls.__name__
+        RESOURCES[cls.__name__] = cls
+        cls._compile()
 
     @classmethod
-    def _parse_list(cls, lst: list):
-        ret = []
-        for i in lst:
-            if type(i) == dict:
-                if "__rid__" in i.keys():
-                    if i["__rid__"] in globals().keys() and issubclass(
-                        globals()[i["__rid__"]], Resource
-                    ):
-                        del i["__rid__"]
-                        ret.append(globals()[i["__rid__"]].from_raw(i))
-                        continue
-                ret.append(cls._parse_dict(i))
-            elif type(i) == list:
-                ret.append(cls._parse_list(i))
-            else:
-                ret.append(i)
-        return ret
+    def _compile(cls):
+        fields = [f for f in cls.__fields__ if not f in cls.__exclude__]
+        values = "".join(
+            f"{f!r}: v if type(v := self.{f}) in _p else _d(v), " for f in fields
+        )
+        defaults = {
+            name: p.default
+            for name, p in signature(cls.__init__).parameters.items()
+            if p.default is not Parameter.empty
+        }
+        loads = "".join(
+            f"    self.{f} = v if type(v := data.get({f!r}, _defaults.get({f!r}))) in _p else _l(v)\n"
+            if type(defaults.get(f)) in PRIMITIVES
+            else f"    self.{f} = _l(data[{f!r}]) if {f!r} in data else _copy(_defaults.get({f!r}))\n"
+            for f in cls.__fields__
+        )
+        namespace = {
+            "_p": PRIMITIVES,
+            "_d": _dump,
+            "_l": _load,
+            "_copy": lambda v: type(v)(v) if type(v) in (list, dict) else v,
+            "_defaults": defaults,
+            "_uuid": _new_uuid,
+            "_cls": cls,
+        }
+        exec(
+            f"def to_dict(self):\n"
+            f"    return {{'__rid__': {cls.__rid__!r}, '__uuid__': self.__uuid__, {values}}}\n"
+            f"def to_dict_clean(self):\n"
+            f"    return {{{values}'uuid': self.__uuid__}}\n"
+            f"def from_dict(data):\n"
+            f"    self = _cls.__new__(_cls)\n"
+            f"    self.__uuid__ = data.get('__uuid__') or data.get('uuid') or _uuid()\n"
+            f"{loads}"
+            f"    return self\n",
+            namespace,
+        )
+        cls._to_dict = namespace["to_dict"]
+        cls._to_dict_clean = namespace["to_dict_clean"]
+        cls._from_dict = staticmethod(namespace["from_dict"])
+
+    def __init__(self, uuid: str = None, **kwargs):
+        self.__uuid__ = uuid if uuid else _new_uuid()
+        for k, v in kwargs.items():
+            setattr(self, k, v)
+
+    @property
+    def __raw__(self):
+        return {f: getattr(self, f) for f in self.__fields__}
 
     @classmethod
     def from_raw(cls, data: str | dict):
         if type(data) == str:
             data = json.loads(data)
-        return cls(**cls._parse_dict(data))
-
-    def _drill(self, dct: dict):
-        ret = {}
-        for k, v in dct.items():
-            if k == "__raw__" or k == "__exclude__" or k in self.__exclude__:
-                continue
-            if isclass(v) and issubclass(v, Resource):
-                ret[k] = v.to_dict()
-            elif type(v) == dict:
-                ret[k] = self._drill(v)
-            elif type(v) == list:
-                ret[k] = self._drill_list(v)
-            else:
-                ret[k] = v
-        return ret
-
-    def _drill_list(self, lst: list):
-        ret = []
-        for i in lst:
-            if i == "__raw__" or i == "__exclude__" or i in self.__exclude__:
-                continue
-            if isclass(i) and issubclass(i, Resource):
-                ret.append(i.to_dict())
-            elif type(i) == dict:
-                ret.append(self._drill(i))
-            elif type(i) == list:
-                ret.append(self._drill_list(i))
-            else:
-                ret.append(i)
+        return cls._from_dict(data)
 
     def to_dict(self):
-        return self._drill(self.__dict__)
+        return self._to_dict()
 
     def to_dict_clean(self):
-        old_ex = self.__exclude__
-        self.__exclude__.extend(["__rid__", "__uuid__"])
-        out = self.to_dict()
-        out["uuid"] = self.__uuid__
-        self.__exclude__ = old_ex
-        return out
+        return self._to_dict_clean()
 
     @classmethod
     def from_db(cls, table: Table, query: QueryLike, one=True):
@@ -116,18 +143,59 @@ class Resource:
             return None if one else []
         return cls.from_raw(result[0]) if one else [cls.from_raw(r) for r in result]
 
-    def save(self, table: Table):
-        table.upsert(self.to_dict(), where("__uuid__") == self.__uuid__)
+    @classmethod
+    def from_store(cls, store: "ResourceStore", uuid: str):
+        doc = store.get(uuid)
+        return cls.from_raw(doc) if doc else None
+
+    def save(self, table: "Table | ResourceStore"):
+        if isinstance(table, Table):
+            table.upsert(self.to_dict(), where("__uuid__") == self.__uuid__)
+        else:
+            table.upsert(self.to_dict())
         return self
 
-    def download(self, fd: FileIO):
+    def download(
+        self,
+        fd: FileIO,
+        cancel: Event = None,
+        chunk_size: int = 65536,
+        block_size: int = 0,
+        progress: "ProgressTracker" = None,
+    ):
         raise NotImplementedError()
 
     def download_pathprefix(self):
         return ""
 
+    def download_host(self):
+        return None
+
+    def download_key(self):
+        return None
+
+    def download_size(self):
+        return None
+
 
 class Podcast(Resource):
+    __fields__ = (
+        "id",
+        "title",
+        "feed_url",
+        "feed_type",
+        "author",
+        "link",
+        "description",
+        "image",
+        "artwork",
+        "categories",
+        "autofetch",
+        "fetched",
+        "last_seen",
+    )
+    __slots__ = __fields__
+
     def __init__(
         self,
         uuid: str = None,
@@ -142,24 +210,10 @@ class Podcast(Resource):
         artwork: str = None,
         categories: dict = {},
         autofetch: boolean = False,
-        fetched: list[str] = []
+        fetched: list[str] = [],
+        last_seen: int = None,
     ):
-        super().__init__(
-            uuid=uuid,
-            id=id,
-            title=title,
-            feed_url=feed_url,
-            feed_type=feed_type,
-            author=author,
-            link=link,
-            description=description,
-            image=image,
-            artwork=artwork,
-            categories=categories,
-            autofetch=autofetch,
-            fetched=fetched
-        )
-        self.__rid__ = "Podcast"
+        super().__init__(uuid)
 
         self.id = id
         self.title = title
@@ -173,6 +227,7 @@ class Podcast(Resource):
         self.categories = categories
         self.autofetch = autofetch
         self.fetched = fetched
+        self.last_seen = last_seen
 
     @classmethod
     def from_feed(cls, f: dict):
@@ -191,6 +246,24 @@ class Podcast(Resource):
 
 
 class PodcastEpisode(Resource):
+    __fields__ = (
+        "id",
+        "title",
+        "link",
+        "description",
+        "publishDate",
+        "content",
+        "contentType",
+        "duration",
+        "isExplicit",
+        "episodeNumber",
+        "episodeType",
+        "episodeSeason",
+        "image",
+        "feed",
+    )
+    __slots__ = __fields__
+
     def __init__(
         self,
         uuid: str = None,
@@ -209,23 +282,7 @@ class PodcastEpisode(Resource):
         image: str = None,
         feed: int = None,
     ):
-        super().__init__(
-            uuid,
-            id=id,
-            title=title,
-            link=link,
-            description=description,
-            publishDate=publishDate,
-            content=content,
-            contentType=contentType,
-            duration=duration,
-            isExplicit=isExplicit,
-            episodeNumber=episodeNumber,
-            episodeType=episodeType,
-            episodeSeason=episodeSeason,
-            image=image,
-            feed=feed
-        )
+        super().__init__(uuid)
 
         self.id = id
         self.title = title
@@ -261,17 +318,103 @@ class PodcastEpisode(Resource):
             feed=item["feedId"]
         )
     
-    def download(self, fd: FileIO):
-        r = requests.get(self.content, stream=True)
-        if r.status_code < 400:
+    def download(
+        self,
+        fd: FileIO,
+        cancel: Event = None,
+        chunk_size: int = 65536,
+        block_size: int = 0,
+        progress: "ProgressTracker" = None,
+        segments: int = 1,
+        segment_min_size: int = 104857600,
+        segment_retries: int = 3,
+    ):
+        if segments > 1:
+            size, ranges = self.probe()
+            if ranges and size and size >= segment_min_size:
+                result = fetch_segmented(
+                    self.content,
+                    fd,
+                    size,
+                    segments,
+                    retries=segment_retries,
+                    cancel=cancel,
+                    chunk_size=chunk_size,
+                    block_size=block_size,
+                    progress=progress,
+                    host=self.download_host(),
+                )
+                if result:
+                    return result
+
+        with get_http().get(self.content, stream=True) as r:
+            if r.status_code >= 400:
+                return False, {"result": "failure", "code": r.status_code, "server_message": str(r.text)}
+
+            if progress:
+                total = r.headers.get("content-length")
+                progress.start(int(total) if total else None)
+            host = self.download_host()
             size = 0
-            for chunk in r.iter_content(chunk_size=4096):
+            digest = hashlib.sha256()
+            buffer = bytearray()
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                if cancel and cancel.is_set():
+                    return False, {"result": "cancelled", "total_size": size}
                 size += len(chunk)
-                fd.write(chunk)
-            return True, {"result": "success", "total_size": size}
-        else:
-            return False, {"result": "failure", "code": r.status_code, "server_message": str(r.text)}
+                shaper.throttle(host, len(chunk))
+                digest.update(chunk)
+                if progress:
+                    progress.advance(len(chunk))
+                if block_size > 0:
+                    buffer += chunk
+                    if len(buffer) >= block_size:
+                        fd.write(bytes(buffer))
+                        buffer.clear()
+                else:
+                    fd.write(chunk)
+            if len(buffer) > 0:
+                fd.write(bytes(buffer))
+            if progress:
+                progress.flush()
+            return True, {
+                "result": "success",
+                "total_size": size,
+                "sha256": digest.hexdigest(),
+            }
 
     def download_pathprefix(self):
         return f"S{self.episodeSeason}E{self.episodeNumber} - "
 
+    def download_name(self):
+        extension = None
+        if self.contentType:
+            extension = mimetypes.guess_extension(self.contentType.split(";")[0].strip())
+        if extension == None and self.content:
+            extension = posixpath.splitext(urlparse(self.content).path)[1]
+            if not (1 < len(extension) <= 6 and extension[1:].isalnum()):
+                extension = None
+        return safe_name(self.title) + (extension or "")
+
+    def download_host(self):
+        return urlparse(self.content).netloc if self.content else None
+
+    def download_key(self):
+        return self.content
+
+    def probe(self) -> tuple[int | None, bool]:
+        # Servers that fail HEAD still get a plain single-stream download
+        try:
+            with get_http().head(self.content, allow_redirects=True) as r:
+                if r.status_code >= 400 or not "content-length" in r.headers.keys():
+                    return None, False
+                return (
+                    int(r.headers["content-length"]),
+                    r.headers.get("accept-ranges", "").lower() == "bytes",
+                )
+        except (RequestException, ValueError):
+            return None, False
+
+    def download_size(self):
+        return self.probe()[0]
+
@@ -0,0 +1,253 @@
+from collections import Counter
+import asyncio
+from threading import Event, Lock, Thread, get_ident
+from time import perf_counter, time
+import cProfile
+import json
+import os
+import pstats
+import random
+import secrets
+import sys
+
+from .aio import offload, offload_wrapper
+from .cfg import cfg
+from .registry import shared
+
+HEADER = b"x-fido-profile"
+MODES = ["sampling", "cprofile"]
+
+_loop_profiler = Lock()
+
+
+class _Sampler(Thread):
+    def __init__(self, interval: float):
+        super().__init__(name="Fido-Profile-Sampler", daemon=True)
+        self.interval = interval
+        self.threads: dict[int, str] = {}
+        self.stacks: Counter[str] = Counter()
+        self.stopped = Event()
+        self.loop = None
+        self.task = None
+
+    def _label(self, label: str) -> str:
+        # The loop thread runs every in-flight request, so its stacks are split by
+        # whether the profiled request's task was the one running. Tasks the request
+        # spawns itself (e.g. streaming bodies) also land under "loop-other".
+        if label == "loop" and self.loop != None:
+            if asyncio.current_task(self.loop) is not self.task:
+                return "loop-other"
+        return label
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frames = sys._current_frames()
+            for ident, label in list(self.threads.items()):
+                frame = frames.get(ident)
+                stack = []
+                while frame != None:
+                    code = frame.f_code
+                    stack.append(
+                        f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                    )
+                    frame = frame.f_back
+                if len(stack) > 0:
+                    self.stacks[";".join([self._label(label)] + stack[::-1])] += 1
+
+
+class RequestProfile:
+    def __init__(self, mode: str, interval: float = 0.005):
+        self.id = f"{int(time() * 1000)}-{secrets.token_hex(4)}"
+        self.mode = mode
+        self.lock = Lock()
+        self.profiles: list[cProfile.Profile] = []
+        self.sampler = None
+        self.started = perf_counter()
+        self.duration = None
+        if mode == "cprofile":
+            self.profiles.append(cProfile.Profile())
+        else:
+            self.sampler = _Sampler(interval)
+            self.sampler.threads[get_ident()] = "loop"
+            self.sampler.loop = asyncio.get_running_loop()
+            self.sampler.task = asyncio.current_task()
+
+    def start(self):
+        if self.sampler:
+            self.sampler.start()
+        else:
+            self.profiles[0].enable()
+
+    def stop(self):
+        self.duration = perf_counter() - self.started
+        if self.sampler:
+            self.sampler.stopped.set()
+            self.sampler.join()
+        else:
+            self.profiles[0].disable()
+
+    def wrap(self, func):
+        def run():
+            if self.sampler:
+                ident = get_ident()
+                self.sampler.threads[ident] = "worker"
+                try:
+                    return func()
+                finally:
+                    self.sampler.threads.pop(ident, None)
+
+            profile = cProfile.Profile()
+            with self.lock:
+                self.profiles.append(profile)
+            profile.enable()
+            try:
+                return func()
+            finally:
+                profile.disable()
+
+        return run
+
+    def dump(self, path: str) -> str:
+        if self.sampler:
+            filename = path + ".collapsed.txt"
+            with open(filename, "w") as f:
+                for stack, count in self.sampler.stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+        else:
+            filename = path + ".pstats"
+            stats = pstats.Stats(self.profiles[0])
+            for profile in self.profiles[1:]:
+                stats.add(profile)
+            stats.dump_stats(filename)
+        return filename
+
+
+class ProfileStore:
+    def __init__(self, path: str, keep: int = 50):
+        self.path = path
+        self.keep = keep
+        self.lock = Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def save(self, profile: RequestProfile, meta: dict):
+        with self.lock:
+            filename = profile.dump(os.path.join(self.path, profile.id))
+            meta = {
+                **meta,
+                "id": profile.id,
+                "mode": profile.mode,
+                "duration": round(profile.duration, 6),
+                "file": os.path.basename(filename),
+                "size": os.path.getsize(filename),
+            }
+            with open(os.path.join(self.path, profile.id + ".json"), "w") as f:
+                json.dump(meta, f)
+            for old in self._ids()[: -self.keep]:
+                self.remove(old)
+
+    def _ids(self) -> list[str]:
+        return sorted(n[:-5] for n in os.listdir(self.path) if n.endswith(".json"))
+
+    def list(self) -> list[dict]:
+        results = []
+        for id in reversed(self._ids()):
+            try:
+                with open(os.path.join(self.path, id + ".json")) as f:
+                    results.append(json.load(f))
+            except (OSError, ValueError):
+                pass
+        return results
+
+    def get(self, id: str) -> dict | None:
+        if not id in self._ids():
+            return None
+        with open(os.path.join(self.path, id + ".json")) as f:
+            meta = json.load(f)
+        meta["local"] = os.path.join(self.path, meta["file"])
+        return meta
+
+    def remove(self, id: str):
+        for name in [n for n in os.listdir(self.path) if n.startswith(id + ".")]:
+            os.remove(os.path.join(self.path, name))
+
+
+class ProfilingMiddleware:
+    def __init__(
+        self,
+        app,
+        store: ProfileStore,
+        authenticated: bool = True,
+        sample_rate: float = 0,
+        mode: str = "sampling",
+        interval: float = 0.005,
+    ):
+        self.app = app
+        self.store = store
+        self.authenticated = authenticated
+        self.sample_rate = sample_rate
+        self.mode = mode
+        self.interval = interval
+
+    def _requested(self, scope) -> str | None:
+        for name, value in scope["headers"]:
+            if name == HEADER:
+                key = scope.get("fido.key")
+                if self.authenticated and (key == None or not "/admin".startswith(key[1])):
+                    return None
+                value = value.decode("latin-1").strip().lower()
+                return value if value in MODES else self.mode
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            return self.mode
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        mode = self._requested(scope)
+        if mode == None:
+            return await self.app(scope, receive, send)
+        if mode == "cprofile" and not _loop_profiler.acquire(blocking=False):
+            return await self.app(scope, receive, send)
+
+        profile = RequestProfile(mode, self.interval)
+        state = {"status": None}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                state["status"] = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"x-fido-profile-id", profile.id.encode("latin-1"))
+                ]
+            await send(message)
+
+        token = offload_wrapper.set(profile.wrap)
+        profile.start()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            profile.stop()
+            offload_wrapper.reset(token)
+            if mode == "cprofile":
+                _loop_profiler.release()
+            await offload(
+                "storage",
+                self.store.save,
+                profile,
+                {
+                    "method": scope["method"],
+                    "path": scope["path"],
+                    "query": scope.get("query_string", b"").decode("latin-1"),
+                    "status": state["status"],
+                    "timestamp": time(),
+                },
+            )
+
+
+def get_profile_store() -> ProfileStore:
+    options = cfg().get("profiling", {})
+    path = options.get(
+        "path", os.path.splitext(cfg()["db_downloads"])[0] + ".profiles"
+    )
+    return shared(
+        "profiles", path, lambda: ProfileStore(path, keep=options.get("keep", 50))
+    )
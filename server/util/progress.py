@@ -0,0 +1,152 @@
+from threading import Lock
+from time import monotonic
+
+from .cfg import cfg
+from .metrics import DOWNLOAD_BYTES
+from .trackers import FINISHED_TYPES
+
+
+class ProgressTracker:
+    def __init__(self, registry: "ProgressRegistry", download_id: str, item_id: str):
+        self.registry = registry
+        self.download_id = download_id
+        self.item_id = item_id
+        self.done = 0
+        self.total = None
+        self.rate = 0.0
+        self.interval = registry.interval
+        self._published = monotonic()
+        self._published_done = 0
+
+    def start(self, total: int | None = None, done: int = 0):
+        self.total = total
+        self.done = done
+        self._published = monotonic()
+        self._published_done = done
+        self.registry._publish(self)
+
+    def advance(self, n: int):
+        self.done += n
+        DOWNLOAD_BYTES.inc(n)
+        now = monotonic()
+        if now - self._published >= self.interval:
+            current = (self.done - self._published_done) / (now - self._published)
+            self.rate = current if self.rate == 0 else self.rate * 0.7 + current * 0.3
+            self._published = now
+            self._published_done = self.done
+            self.registry._publish(self)
+
+    def flush(self):
+        self.registry._publish(self)
+
+
+class ProgressRegistry:
+    def __init__(self, interval: float = 0.5, retention: float = 300):
+        self.interval = interval
+        self.retention = retention
+        self.lock = Lock()
+        self.downloads: dict[str, dict[str, dict]] = {}
+        self.versions: dict[str, int] = {}
+        self.finished: dict[str, float] = {}
+        self.shared = None
+
+    def share(self, queue):
+        self.shared = queue
+
+    def register(self, download_id: str, item_ids: list[str]):
+        if self.shared:
+            return
+        with self.lock:
+            self._expire()
+            self.downloads[download_id] = {
+                i: {
+                    "item_id": i,
+                    "type": "queued",
+                    "bytes": 0,
+                    "total": None,
+                    "rate": 0.0,
+                    "eta": None,
+                }
+                for i in item_ids
+            }
+            self.versions[download_id] = 0
+            if len(item_ids) == 0:
+                self.finished[download_id] = monotonic()
+
+    def tracker(self, download_id: str, item_id: str) -> ProgressTracker:
+        return ProgressTracker(self, download_id, item_id)
+
+    def set_state(self, download_id: str, item_id: str, state: str):
+        if self.shared:
+            return self.shared.set_state(download_id, item_id, state)
+        with self.lock:
+            if not download_id in self.downloads.keys():
+                return
+            item = self.downloads[download_id].get(item_id)
+            if item == None:
+                return
+            item["type"] = state
+            if state in FINISHED_TYPES:
+                item["rate"] = 0.0
+                item["eta"] = None
+            self.versions[download_id] += 1
+            if all(i["type"] in FINISHED_TYPES for i in self.downloads[download_id].values()):
+                self.finished[download_id] = monotonic()
+
+    def _publish(self, tracker: ProgressTracker):
+        if self.shared:
+            return self.shared.publish(
+                tracker.download_id, tracker.item_id, self._fields(tracker)
+            )
+        with self.lock:
+            items = self.downloads.get(tracker.download_id)
+            if items == None or not tracker.item_id in items.keys():
+                return
+            items[tracker.item_id].update(self._fields(tracker))
+            self.versions[tracker.download_id] += 1
+
+    def _fields(self, tracker: ProgressTracker) -> dict:
+        return {
+            "bytes": tracker.done,
+            "total": tracker.total,
+            "rate": round(tracker.rate, 1),
+            "eta": (
+                round((tracker.total - tracker.done) / tracker.rate, 1)
+                if tracker.total and tracker.rate > 0
+                else None
+            ),
+        }
+
+    def _expire(self):
+        now = monotonic()
+        for download_id in [d for d, t in self.finished.items() if now - t > self.retention]:
+            del self.finished[download_id]
+            del self.downloads[download_id]
+            del self.versions[download_id]
+
+    def version(self, download_id: str) -> int | None:
+        if self.shared:
+            return self.shared.version(download_id)
+        with self.lock:
+            self._expire()
+            return self.versions.get(download_id)
+
+    def snapshot(self, download_id: str) -> dict | None:
+        if self.shared:
+            return self.shared.snapshot(download_id)
+        with self.lock:
+            self._expire()
+            if not download_id in self.downloads.keys():
+                return None
+            items = [dict(i) for i in self.downloads[download_id].values()]
+            return {
+                "download_id": download_id,
+                "finished": download_id in self.finished.keys(),
+                "bytes": sum(i["bytes"] for i in items),
+                "total": sum(i["total"] or 0 for i in items),
+                "rate": round(sum(i["rate"] for i in items), 1),
+                "items": items,
+            }
+
+
+progress = ProgressRegistry(**cfg().get("progress", {}))
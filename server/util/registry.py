@@ -0,0 +1,17 @@
+from threading import RLock
+from typing import Callable, Hashable
+
+_shared: dict[tuple[str, Hashable], object] = {}
+_lock = RLock()
+
+
+def shared(kind: str, key: Hashable, factory: Callable[[], object]):
+    with _lock:
+        if not (kind, key) in _shared.keys():
+            _shared[(kind, key)] = factory()
+        return _shared[(kind, key)]
+
+
+def shared_items(kind: str) -> dict[Hashable, object]:
+    with _lock:
+        return {k: v for (t, k), v in _shared.items() if t == kind}
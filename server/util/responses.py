@@ -0,0 +1,44 @@
+import json
+from typing import Any
+
+from fastapi import Request, Response
+from fastapi.responses import JSONResponse
+
+from .compression import parse_tags
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(content: Any) -> bytes:
+    if orjson:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(
+        content, ensure_ascii=False, allow_nan=False, separators=(",", ":")
+    ).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def etag(*parts) -> str | None:
+    if None in parts:
+        return None
+    return '"' + "-".join(str(p) for p in parts) + '"'
+
+
+def fresh(request: Request, tag: str | None) -> bool:
+    if tag == None:
+        return False
+    header = request.headers.get("if-none-match")
+    if header == None:
+        return False
+    return header.strip() == "*" or tag in parse_tags(header)
+
+
+def not_modified_response(tag: str) -> Response:
+    return Response(status_code=304, headers={"etag": tag, "cache-control": "no-cache"})
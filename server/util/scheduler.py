@@ -0,0 +1,168 @@
+from collections import OrderedDict, deque
+from threading import Condition, Event, Lock, Thread
+from typing import Callable
+import logging
+
+from .cfg import cfg
+from .metrics import gauge
+
+log = logging.getLogger("uvicorn.error")
+
+
+class DownloadJob:
+    def __init__(
+        self,
+        download_id: str,
+        item_id: str,
+        run: Callable[["DownloadJob"], None],
+        on_cancel: Callable[["DownloadJob"], None] = None,
+        host: str = None,
+        priority: int = 0,
+    ):
+        self.download_id = download_id
+        self.item_id = item_id
+        self.run = run
+        self.on_cancel = on_cancel
+        self.host = host
+        self.priority = priority
+        self.cancelled = Event()
+
+
+class DownloadScheduler:
+    def __init__(self, workers: int = 4, host_limit: int = 0):
+        self.workers = workers
+        self.host_limit = host_limit
+        self.condition = Condition()
+        self.queues: dict[int, OrderedDict[str, deque[DownloadJob]]] = {}
+        self.running: dict[tuple[str, str], DownloadJob] = {}
+        self.host_counts: dict[str, int] = {}
+        self.threads = [
+            Thread(target=self._work, name=f"Fido-Download-Worker-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for t in self.threads:
+            t.start()
+
+    @property
+    def queued(self) -> int:
+        with self.condition:
+            return sum(
+                len(jobs) for batches in self.queues.values() for jobs in batches.values()
+            )
+
+    @property
+    def active(self) -> int:
+        with self.condition:
+            return len(self.running)
+
+    def submit(self, jobs: list[DownloadJob]):
+        with self.condition:
+            for job in jobs:
+                self.queues.setdefault(job.priority, OrderedDict()).setdefault(
+                    job.download_id, deque()
+                ).append(job)
+            self.condition.notify_all()
+
+    def cancel(self, download_id: str, item_id: str = None) -> list[str]:
+        cancelled = []
+        signalled = []
+        with self.condition:
+            for batches in self.queues.values():
+                if not download_id in batches.keys():
+                    continue
+                jobs = batches[download_id]
+                for job in [j for j in jobs if item_id == None or j.item_id == item_id]:
+                    jobs.remove(job)
+                    cancelled.append(job)
+                if len(jobs) == 0:
+                    del batches[download_id]
+            for priority in [p for p, b in self.queues.items() if len(b) == 0]:
+                del self.queues[priority]
+            for (did, iid), job in self.running.items():
+                if did == download_id and (item_id == None or iid == item_id):
+                    job.cancelled.set()
+                    signalled.append(job)
+        for job in cancelled:
+            job.cancelled.set()
+            if job.on_cancel:
+                job.on_cancel(job)
+        return [job.item_id for job in cancelled + signalled]
+
+    def _eligible(self, job: DownloadJob) -> bool:
+        return (
+            self.host_limit <= 0
+            or job.host == None
+            or self.host_counts.get(job.host, 0) < self.host_limit
+        )
+
+    def _next(self) -> DownloadJob | None:
+        for priority in sorted(self.queues.keys()):
+            batches = self.queues[priority]
+            for download_id in list(batches.keys()):
+                jobs = batches[download_id]
+                job = next((j for j in jobs if self._eligible(j)), None)
+                if job == None:
+                    continue
+                jobs.remove(job)
+                if len(jobs) == 0:
+                    del batches[download_id]
+                else:
+                    batches.move_to_end(download_id)
+                if len(batches) == 0:
+                    del self.queues[priority]
+                return job
+        return None
+
+    def _work(self):
+        while True:
+            with self.condition:
+                job = self._next()
+                while job == None:
+                    self.condition.wait()
+                    job = self._next()
+                self.running[(job.download_id, job.item_id)] = job
+                if job.host:
+                    self.host_counts[job.host] = self.host_counts.get(job.host, 0) + 1
+
+            try:
+                job.run(job)
+            except:
+                log.exception(f"Download job {job.download_id}/{job.item_id} failed")
+            finally:
+                with self.condition:
+                    del self.running[(job.download_id, job.item_id)]
+                    if job.host:
+                        self.host_counts[job.host] -= 1
+                    self.condition.notify_all()
+
+
+_scheduler: DownloadScheduler = None
+_scheduler_lock = Lock()
+
+
+gauge(
+    "fido_download_queue_depth",
+    "Download jobs waiting for a local worker",
+    lambda: _scheduler.queued if _scheduler else None,
+)
+gauge(
+    "fido_download_active",
+    "Download jobs currently running",
+    lambda: _scheduler.active if _scheduler else None,
+)
+gauge(
+    "fido_download_workers",
+    "Download worker threads",
+    lambda: _scheduler.workers if _scheduler else None,
+)
+
+
+def get_scheduler() -> DownloadScheduler:
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler == None:
+            _scheduler = DownloadScheduler(
+                workers=cfg().get("download_workers", 4),
+                host_limit=cfg().get("download_host_limit", 0),
+            )
+    return _scheduler
@@ -0,0 +1,144 @@
+from concurrent.futures import ThreadPoolExecutor
+from io import FileIO
+from tempfile import TemporaryFile
+from threading import Event, Lock
+import hashlib
+
+from .bandwidth import shaper
+from .http import get_http
+from .progress import ProgressTracker
+
+
+class RangesNotSupported(Exception):
+    pass
+
+
+def split_ranges(size: int, segments: int) -> list[tuple[int, int]]:
+    step = -(-size // segments)
+    return [(start, min(start + step, size)) for start in range(0, size, step)]
+
+
+def _fetch_segment(
+    url: str,
+    start: int,
+    end: int,
+    spool,
+    retries: int,
+    stop: Event,
+    chunk_size: int,
+    host: str,
+    report,
+):
+    written = 0
+    attempt = 0
+    while written < end - start:
+        try:
+            with get_http().get(
+                url,
+                stream=True,
+                headers={"Range": f"bytes={start + written}-{end - 1}"},
+            ) as r:
+                if r.status_code == 200:
+                    raise RangesNotSupported()
+                r.raise_for_status()
+                for chunk in r.iter_content(chunk_size=chunk_size):
+                    if stop.is_set():
+                        return
+                    chunk = chunk[: end - start - written]
+                    shaper.throttle(host, len(chunk))
+                    spool.write(chunk)
+                    written += len(chunk)
+                    report(len(chunk))
+            if written < end - start:
+                raise IOError(f"Segment {start}-{end - 1} ended early")
+        except RangesNotSupported:
+            raise
+        except Exception:
+            attempt += 1
+            if attempt > retries or stop.is_set():
+                raise
+
+
+def fetch_segmented(
+    url: str,
+    fd: FileIO,
+    size: int,
+    segments: int,
+    retries: int = 3,
+    cancel: Event = None,
+    chunk_size: int = 65536,
+    block_size: int = 0,
+    progress: ProgressTracker = None,
+    host: str = None,
+):
+    stop = Event()
+    lock = Lock()
+
+    def report(n: int):
+        if cancel and cancel.is_set():
+            stop.set()
+        if progress:
+            with lock:
+                progress.advance(n)
+
+    ranges = split_ranges(size, segments)
+    spools = [TemporaryFile() for _ in ranges]
+    digest = hashlib.sha256()
+    written = 0
+    if progress:
+        progress.start(size)
+    try:
+        with ThreadPoolExecutor(
+            max_workers=len(ranges), thread_name_prefix="Fido-Segment"
+        ) as executor:
+            futures = [
+                executor.submit(
+                    _fetch_segment,
+                    url,
+                    start,
+                    end,
+                    spool,
+                    retries,
+                    stop,
+                    chunk_size,
+                    host,
+                    report,
+                )
+                for (start, end), spool in zip(ranges, spools)
+            ]
+            try:
+                for future, spool in zip(futures, spools):
+                    future.result()
+                    if stop.is_set():
+                        break
+                    spool.seek(0)
+                    while True:
+                        block = spool.read(max(block_size, chunk_size))
+                        if not block:
+                            break
+                        digest.update(block)
+                        fd.write(block)
+                        written += len(block)
+                    spool.close()
+            except RangesNotSupported:
+                stop.set()
+                if written > 0:
+                    raise IOError("Server stopped honouring ranges mid-download")
+                return None
+            except Exception as e:
+                stop.set()
+                return False, {"result": "failure", "error": str(e), "total_size": written}
+    finally:
+        for spool in spools:
+            spool.close()
+
+    if cancel and cancel.is_set():
+        return False, {"result": "cancelled", "total_size": written}
+    if progress:
+        progress.flush()
+    return True, {
+        "result": "success",
+        "total_size": written,
+        "sha256": digest.hexdigest(),
+        "segments": len(ranges),
+    }
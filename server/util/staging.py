@@ -0,0 +1,220 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import sleep
+from typing import Callable
+import fcntl
+import logging
+import os
+import posixpath
+import shutil
+import socket
+
+from .cfg import cfg
+from .registry import shared
+
+log = logging.getLogger("uvicorn.error")
+
+
+class StagingArea:
+    # Each process stages into its own subdirectory of root, locked with
+    # flock for as long as the process lives. Committed files on disk are the
+    # pending set, so every worker sees every staged file, and recovery only
+    # adopts areas whose owner has gone away.
+    def __init__(
+        self,
+        root: str,
+        uploaders: int = 2,
+        retries: int = 5,
+        backoff: float = 2,
+    ):
+        self.root = root
+        self.retries = retries
+        self.backoff = backoff
+        self.lock = Lock()
+        self.recovered = False
+        self.owner = f"{socket.gethostname()}-{os.getpid()}"
+        self.home = os.path.join(root, self.owner)
+        self.executor = ThreadPoolExecutor(
+            max_workers=uploaders, thread_name_prefix="Fido-Uploader"
+        )
+        os.makedirs(self.home, exist_ok=True)
+        self.lock_file = open(os.path.join(self.home, ".lock"), "a")
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    def _key(self, path: str) -> str:
+        return posixpath.normpath(path.strip("/"))
+
+    def _owners(self) -> list[str]:
+        try:
+            others = [
+                n
+                for n in os.listdir(self.root)
+                if n != self.owner and os.path.exists(os.path.join(self.root, n, ".lock"))
+            ]
+        except FileNotFoundError:
+            others = []
+        return [self.owner] + others
+
+    def _locate(self, key: str) -> str | None:
+        for owner in self._owners():
+            local = os.path.join(self.root, owner, key)
+            if os.path.isfile(local):
+                return local
+        return None
+
+    def local_path(self, path: str) -> str:
+        return os.path.join(self.home, self._key(path))
+
+    def open(self, path: str):
+        local = self.local_path(path)
+        os.makedirs(os.path.dirname(local), exist_ok=True)
+        return open(local + ".part", "wb")
+
+    def discard(self, path: str):
+        local = self.local_path(path)
+        for p in [local + ".part", local]:
+            if os.path.exists(p):
+                os.remove(p)
+
+    def commit(self, path: str):
+        local = self.local_path(path)
+        os.replace(local + ".part", local)
+
+    def info(self, path: str) -> dict | None:
+        key = self._key(path)
+        local = self._locate(key)
+        if local == None:
+            return None
+        try:
+            stat = os.stat(local)
+        except FileNotFoundError:
+            return None
+        return {
+            "name": key,
+            "type": "file",
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "local": local,
+        }
+
+    def entries(self, directory: str) -> list[dict]:
+        directory = self._key(directory)
+        directory = "" if directory == "." else directory
+        results = {}
+        for owner in self._owners():
+            folder = os.path.join(self.root, owner, directory)
+            try:
+                names = os.listdir(folder)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            for name in names:
+                if name.endswith(".part") or name == ".lock" or name in results.keys():
+                    continue
+                try:
+                    stat = os.stat(os.path.join(folder, name))
+                except FileNotFoundError:
+                    continue
+                if os.path.isdir(os.path.join(folder, name)):
+                    continue
+                results[name] = {
+                    "path": name,
+                    "is_directory": False,
+                    "size": stat.st_size,
+                    "modified": stat.st_mtime,
+                }
+        return list(results.values())
+
+    def _collect(self, area: str) -> list[str]:
+        # Drops partial writes and moves committed files into our own area
+        found = []
+        for directory, _, files in os.walk(area):
+            for name in files:
+                source = os.path.join(directory, name)
+                if name == ".lock" and directory == area:
+                    continue
+                if name.endswith(".part"):
+                    os.remove(source)
+                    continue
+                key = self._key(os.path.relpath(source, area).replace(os.sep, "/"))
+                if area != self.home:
+                    os.makedirs(os.path.dirname(self.local_path(key)), exist_ok=True)
+                    os.replace(source, self.local_path(key))
+                found.append(key)
+        return found
+
+    def _adopt(self, owner: str) -> list[str]:
+        area = os.path.join(self.root, owner)
+        try:
+            lock = open(os.path.join(area, ".lock"), "a")
+        except OSError:
+            return []
+        with lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return []
+            found = self._collect(area)
+            shutil.rmtree(area, ignore_errors=True)
+        if len(found) > 0:
+            log.info(f"Adopted {len(found)} staged files from {owner}")
+        return found
+
+    def recover(self) -> list[str]:
+        found = []
+        with self.lock:
+            if not self.recovered:
+                # Leftovers from an earlier process that had our pid
+                found += self._collect(self.home)
+                self.recovered = True
+        for owner in self._owners()[1:]:
+            found += self._adopt(owner)
+        return found
+
+    def upload(
+        self,
+        path: str,
+        transfer: Callable[[str], None],
+        started: Callable[[int], None],
+        finished: Callable[[Exception | None], None],
+    ):
+        self.executor.submit(self._upload, path, transfer, started, finished)
+
+    def _upload(self, path, transfer, started, finished):
+        local = self.local_path(path)
+        error = None
+        for attempt in range(self.retries + 1):
+            try:
+                started(attempt)
+                transfer(local)
+                error = None
+                break
+            except Exception as e:
+                error = e
+                log.warning(
+                    "Upload of staged %s failed (attempt %s): %s", path, attempt + 1, e
+                )
+                if attempt < self.retries:
+                    sleep(self.backoff * 2**attempt)
+
+        if error == None:
+            os.remove(local)
+        try:
+            finished(error)
+        except:
+            log.exception(f"Failed to record upload result for {path}")
+
+
+def get_staging() -> StagingArea | None:
+    options = cfg().get("staging")
+    if not options:
+        return None
+    return shared(
+        "staging",
+        options["path"],
+        lambda: StagingArea(
+            options["path"],
+            uploaders=options.get("uploaders", 2),
+            retries=options.get("retries", 5),
+            backoff=options.get("backoff", 2),
+        ),
+    )
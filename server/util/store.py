@@ -0,0 +1,162 @@
+import json
+import logging
+import os
+import re
+import secrets
+import sqlite3
+from time import perf_counter
+from threading import RLock
+
+from tinydb import TinyDB
+
+from .metrics import DB_DURATION, timed
+
+log = logging.getLogger("uvicorn.error")
+
+
+class ResourceStore:
+    def __init__(self, path: str, table: str, migrate_from: str = None):
+        if not re.fullmatch(r"[A-Za-z_][A-Za-z0-9_]*", table):
+            raise ValueError(f"Invalid table name {table}")
+        self.table = table
+        self.lock = RLock()
+        self._revision = 0
+        # Revisions are per process, so versions carry an instance token to stay unique
+        self.instance = secrets.token_hex(4)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("PRAGMA busy_timeout=5000")
+        self.db.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} (uuid TEXT PRIMARY KEY, feed_id INTEGER, data TEXT NOT NULL)"
+        )
+        self.db.execute(
+            f"CREATE INDEX IF NOT EXISTS {table}_feed_id ON {table} (feed_id)"
+        )
+
+        self.docs: dict[str, dict] = {}
+        self.by_feed: dict[int, set[str]] = {}
+        self.data_version = None
+        self._sync()
+
+        if len(self.docs) == 0 and migrate_from and os.path.exists(migrate_from):
+            self.migrate(migrate_from)
+
+    def migrate(self, tinydb_path: str):
+        docs = [dict(d) for d in TinyDB(tinydb_path).table(self.table).all()]
+        docs = [d for d in docs if "__uuid__" in d.keys()]
+        for doc in docs:
+            # Older podcast records stored fetched as null
+            if "fetched" in doc.keys() and doc["fetched"] == None:
+                doc["fetched"] = []
+        if len(docs) > 0:
+            self.upsert_many(docs)
+            log.info(
+                f"Migrated {len(docs)} records from {tinydb_path} into table {self.table}"
+            )
+
+    @property
+    def revision(self) -> int:
+        with self.lock:
+            self._sync()
+            return self._revision
+
+    @property
+    def version(self) -> str:
+        return f"{self.instance}.{self.revision}"
+
+    def _sync(self):
+        # Picks up commits made by other processes sharing the database file
+        version = self.db.execute("PRAGMA data_version").fetchone()[0]
+        if version == self.data_version:
+            return
+        self.data_version = version
+        started = perf_counter()
+        self.docs = {}
+        self.by_feed = {}
+        for uuid, data in self.db.execute(f"SELECT uuid, data FROM {self.table}"):
+            self._cache(json.loads(data))
+        self._revision += 1
+        DB_DURATION.observe(perf_counter() - started, "feeds", "reload")
+
+    def _cache(self, doc: dict):
+        uuid = doc["__uuid__"]
+        if uuid in self.docs.keys():
+            self._uncache(uuid)
+        self.docs[uuid] = doc
+        self.by_feed.setdefault(doc.get("id"), set()).add(uuid)
+
+    def _uncache(self, uuid: str):
+        doc = self.docs.pop(uuid)
+        self.by_feed.get(doc.get("id"), set()).discard(uuid)
+
+    def get(self, uuid: str) -> dict | None:
+        with self.lock:
+            self._sync()
+            return self.docs.get(uuid)
+
+    def get_by_feed(self, feed_id: int) -> list[dict]:
+        with self.lock:
+            self._sync()
+            return [self.docs[u] for u in self.by_feed.get(feed_id, set())]
+
+    def uuids_by_feed(self, feed_ids: list[int]) -> dict[int, str]:
+        with self.lock:
+            self._sync()
+            return {
+                f: next(iter(self.by_feed[f]))
+                for f in feed_ids
+                if len(self.by_feed.get(f, set())) > 0
+            }
+
+    def existing(self, uuids: list[str]) -> list[str]:
+        with self.lock:
+            self._sync()
+            return [u for u in uuids if u in self.docs.keys()]
+
+    def all(self) -> list[dict]:
+        with self.lock:
+            self._sync()
+            return list(self.docs.values())
+
+    def upsert(self, doc: dict):
+        self.upsert_many([doc])
+
+    @timed(DB_DURATION, "feeds", "upsert")
+    def upsert_many(self, docs: list[dict]):
+        with self.lock:
+            with self.db:
+                self.db.executemany(
+                    f"INSERT OR REPLACE INTO {self.table} (uuid, feed_id, data) VALUES (?, ?, ?)",
+                    [(d["__uuid__"], d.get("id"), json.dumps(d)) for d in docs],
+                )
+            for doc in docs:
+                self._cache(doc)
+            self._revision += 1
+
+    def update(self, uuid: str, fields: dict) -> bool:
+        with self.lock:
+            self._sync()
+            if not uuid in self.docs.keys():
+                return False
+            self.upsert({**self.docs[uuid], **fields})
+            return True
+
+    def remove(self, uuid: str) -> int:
+        return self.remove_many([uuid])
+
+    @timed(DB_DURATION, "feeds", "remove")
+    def remove_many(self, uuids: list[str]) -> int:
+        with self.lock:
+            self._sync()
+            uuids = [u for u in uuids if u in self.docs.keys()]
+            if len(uuids) == 0:
+                return 0
+            with self.db:
+                self.db.executemany(
+                    f"DELETE FROM {self.table} WHERE uuid = ?", [(u,) for u in uuids]
+                )
+            for uuid in uuids:
+                self._uncache(uuid)
+            self._revision += 1
+            return len(uuids)
@@ -0,0 +1,168 @@
+from email.utils import formatdate, parsedate_to_datetime
+from hashlib import md5
+from secrets import token_hex
+from typing import Iterator, Mapping
+
+from fastapi.responses import Response, StreamingResponse
+from starlette.status import *
+
+from .cfg import cfg
+from .compression import parse_tags
+from .fs import TargetFileSystem, modified_time
+
+DEFAULT_BLOCK_SIZE = 1048576
+
+
+def block_size() -> int:
+    return cfg().get("stream_block_size", DEFAULT_BLOCK_SIZE)
+
+
+def validators(info: dict) -> dict[str, str]:
+    mtime = modified_time(info)
+    headers = {
+        "etag": '"'
+        + md5(f"{mtime}-{info['size']}".encode("utf-8"), usedforsecurity=False).hexdigest()
+        + '"',
+        "accept-ranges": "bytes",
+    }
+    if mtime != None:
+        headers["last-modified"] = formatdate(mtime, usegmt=True)
+    return headers
+
+
+def not_modified(request_headers: Mapping[str, str], info: dict, etag: str) -> bool:
+    if "if-none-match" in request_headers.keys():
+        tags = parse_tags(request_headers["if-none-match"])
+        return "*" in tags or etag in tags
+    if "if-modified-since" in request_headers.keys():
+        mtime = modified_time(info)
+        try:
+            since = parsedate_to_datetime(request_headers["if-modified-since"]).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return mtime != None and int(mtime) <= since
+    return False
+
+
+def if_range_matches(request_headers: Mapping[str, str], headers: dict[str, str]) -> bool:
+    if not "if-range" in request_headers.keys():
+        return True
+    value = request_headers["if-range"]
+    return value == headers["etag"] or value == headers.get("last-modified")
+
+
+def parse_range(value: str, size: int) -> list[tuple[int, int]] | None:
+    units, _, spec = value.partition("=")
+    if units.strip() != "bytes" or not spec:
+        return None
+    ranges = []
+    for part in spec.split(","):
+        start, sep, end = part.strip().partition("-")
+        if not sep:
+            return None
+        try:
+            if start == "":
+                length = int(end)
+                if length == 0:
+                    continue
+                ranges.append((max(size - length, 0), size))
+            else:
+                first = int(start)
+                last = min(int(end) + 1, size) if end else size
+                if last <= first and end:
+                    return None
+                if first < size:
+                    ranges.append((first, last))
+        except ValueError:
+            return None
+
+    ranges.sort()
+    merged: list[tuple[int, int]] = []
+    for start, end in ranges:
+        if len(merged) > 0 and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def iter_range(
+    fs: TargetFileSystem, path: str, start: int, end: int, block: int
+) -> Iterator[bytes]:
+    with fs.open(path, mode="rb", block_size=block) as f:
+        f.seek(start)
+        while start < end:
+            chunk = f.read(min(block, end - start))
+            if not chunk:
+                break
+            start += len(chunk)
+            yield chunk
+
+
+def stream_file(
+    fs: TargetFileSystem,
+    path: str,
+    info: dict,
+    request_headers: Mapping[str, str],
+    media_type: str,
+    headers: dict[str, str],
+) -> Response:
+    size = info["size"]
+    block = block_size()
+    ranges = None
+    if "range" in request_headers.keys() and if_range_matches(request_headers, headers):
+        ranges = parse_range(request_headers["range"], size)
+
+    if ranges == None:
+        headers["content-length"] = str(size)
+        return StreamingResponse(
+            iter_range(fs, path, 0, size, block), media_type=media_type, headers=headers
+        )
+
+    if len(ranges) == 0:
+        return Response(
+            status_code=HTTP_416_RANGE_NOT_SATISFIABLE,
+            headers={"content-range": f"bytes */{size}"},
+        )
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers["content-range"] = f"bytes {start}-{end - 1}/{size}"
+        headers["content-length"] = str(end - start)
+        return StreamingResponse(
+            iter_range(fs, path, start, end, block),
+            status_code=HTTP_206_PARTIAL_CONTENT,
+            media_type=media_type,
+            headers=headers,
+        )
+
+    boundary = token_hex(13)
+    parts = [
+        (
+            start,
+            end,
+            (
+                f"--{boundary}\r\nContent-Type: {media_type}\r\n"
+                f"Content-Range: bytes {start}-{end - 1}/{size}\r\n\r\n"
+            ).encode("latin-1"),
+        )
+        for start, end in ranges
+    ]
+    closing = f"--{boundary}--".encode("latin-1")
+
+    def iter_parts():
+        for start, end, head in parts:
+            yield head
+            yield from iter_range(fs, path, start, end, block)
+            yield b"\r\n"
+        yield closing
+
+    headers["content-length"] = str(
+        sum(len(head) + (end - start) + 2 for start, end, head in parts) + len(closing)
+    )
+    return StreamingResponse(
+        iter_parts(),
+        status_code=HTTP_206_PARTIAL_CONTENT,
+        media_type=f"multipart/byteranges; boundary={boundary}",
+        headers=headers,
+    )
@@ -0,0 +1,350 @@
+from copy import deepcopy
+import heapq
+import json
+import sqlite3
+from threading import Event, RLock, Thread
+from tinydb import TinyDB, where
+
+from .metrics import DB_DURATION, timed
+
+TRACKER_FIELDS = [
+    "type",
+    "path",
+    "startedTimestamp",
+    "completedTimestamp",
+    "message",
+    "container",
+    "download_id",
+    "item_id",
+]
+FINISHED_TYPES = ["complete", "error", "cancelled", "skipped"]
+
+
+def _summarize(summary: dict | None, download_id: str, records: list[dict]) -> dict:
+    summary = summary or {
+        "download_id": download_id,
+        "items": 0,
+        "types": {},
+        "containers": [],
+        "started": None,
+        "completed": None,
+    }
+    for r in records:
+        summary["items"] += 1
+        summary["types"][r["type"]] = summary["types"].get(r["type"], 0) + 1
+        if r["container"] != None and not r["container"] in summary["containers"]:
+            summary["containers"].append(r["container"])
+        if r["startedTimestamp"] != None:
+            summary["started"] = min(
+                summary["started"] or r["startedTimestamp"], r["startedTimestamp"]
+            )
+        if r["completedTimestamp"] != None:
+            summary["completed"] = max(
+                summary["completed"] or 0, r["completedTimestamp"]
+            )
+    return summary
+
+
+class TrackerStore:
+    def __init__(self, flush_interval: float = 0.5, batch_size: int = 64):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.lock = RLock()
+        self.pending: dict[tuple[str, str], dict] = {}
+        self._stop = Event()
+        self._wake = Event()
+        self._flusher = Thread(
+            target=self._flush_loop, name="Fido-Tracker-Flusher", daemon=True
+        )
+        self._flusher.start()
+
+    def _flush_loop(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    @timed(DB_DURATION, "trackers", "insert")
+    def insert_many(self, records: list[dict]):
+        with self.lock:
+            self._insert(records)
+
+    def update(self, download_id: str, item_id: str, fields: dict):
+        with self.lock:
+            self.pending.setdefault((download_id, item_id), {}).update(fields)
+            if len(self.pending) >= self.batch_size:
+                self._wake.set()
+
+    def flush(self):
+        with self.lock:
+            if len(self.pending) == 0:
+                return
+            updates = list(self.pending.items())
+            self.pending = {}
+            with DB_DURATION.time("trackers", "flush"):
+                self._write_updates(updates)
+
+    @timed(DB_DURATION, "trackers", "search")
+    def search(self, download_id: str) -> list[dict]:
+        with self.lock:
+            self.flush()
+            return self._select(download_id)
+
+    @timed(DB_DURATION, "trackers", "remove_finished")
+    def remove_finished(self, before: float) -> int:
+        # Expired rows are folded into one summary per download instead of dropped
+        with self.lock:
+            self.flush()
+            due = self._due(before)
+            if len(due) == 0:
+                return 0
+            batches: dict[str, list[dict]] = {}
+            for record in due:
+                batches.setdefault(record["download_id"], []).append(record)
+            existing = self._summaries(list(batches.keys()))
+            self._compact(
+                due,
+                [
+                    _summarize(existing.get(did), did, records)
+                    for did, records in batches.items()
+                ],
+            )
+            return len(due)
+
+    def summary(self, download_id: str) -> dict | None:
+        with self.lock:
+            self.flush()
+            compacted = self._summaries([download_id]).get(download_id)
+            live = self._select(download_id)
+            if compacted == None and len(live) == 0:
+                return None
+            return _summarize(compacted, download_id, live)
+
+    @timed(DB_DURATION, "trackers", "remove_summaries")
+    def remove_summaries(self, before: float) -> int:
+        with self.lock:
+            return self._remove_summaries(before)
+
+    def close(self):
+        self._stop.set()
+        self._wake.set()
+        self.flush()
+
+    def _insert(self, records: list[dict]):
+        raise NotImplementedError()
+
+    def _write_updates(self, updates: list[tuple[tuple[str, str], dict]]):
+        raise NotImplementedError()
+
+    def _select(self, download_id: str) -> list[dict]:
+        raise NotImplementedError()
+
+    def _due(self, before: float) -> list[dict]:
+        raise NotImplementedError()
+
+    def _summaries(self, download_ids: list[str]) -> dict[str, dict]:
+        raise NotImplementedError()
+
+    def _compact(self, due: list[dict], summaries: list[dict]):
+        raise NotImplementedError()
+
+    def _remove_summaries(self, before: float) -> int:
+        raise NotImplementedError()
+
+
+class TinyDBTrackerStore(TrackerStore):
+    def __init__(self, path: str, **kwargs):
+        self.db = TinyDB(path)
+        self.summary_table = self.db.table("summaries")
+        # TinyDB has no indexes, so expiry runs off an in-memory heap of
+        # (completedTimestamp, doc_id) built with a single scan at startup
+        self.doc_ids: dict[tuple[str, str], int] = {}
+        self.expiry: list[tuple[float, int]] = []
+        for doc in self.db.all():
+            self._track(doc, doc.doc_id)
+        super().__init__(**kwargs)
+
+    def _track(self, record: dict, doc_id: int):
+        self.doc_ids[(record["download_id"], record["item_id"])] = doc_id
+        if record.get("completedTimestamp") != None:
+            heapq.heappush(self.expiry, (record["completedTimestamp"], doc_id))
+
+    def _insert(self, records: list[dict]):
+        for record, doc_id in zip(records, self.db.insert_multiple(records)):
+            self._track(record, doc_id)
+
+    def _write_updates(self, updates: list[tuple[tuple[str, str], dict]]):
+        self.db.update_multiple(
+            [
+                (fields, (where("download_id") == did) & (where("item_id") == iid))
+                for (did, iid), fields in updates
+            ]
+        )
+        for key, fields in updates:
+            if fields.get("completedTimestamp") != None and key in self.doc_ids.keys():
+                heapq.heappush(
+                    self.expiry, (fields["completedTimestamp"], self.doc_ids[key])
+                )
+
+    def _select(self, download_id: str) -> list[dict]:
+        return [dict(r) for r in self.db.search(where("download_id") == download_id)]
+
+    def _due(self, before: float) -> list[dict]:
+        doc_ids = []
+        while len(self.expiry) > 0 and self.expiry[0][0] < before:
+            doc_ids.append(heapq.heappop(self.expiry)[1])
+        if len(doc_ids) == 0:
+            return []
+        due = []
+        for doc in self.db.get(doc_ids=list(dict.fromkeys(doc_ids))):
+            # Entries go stale when a row is retried or finishes again later
+            if (
+                doc != None
+                and doc["type"] in FINISHED_TYPES
+                and doc["completedTimestamp"] != None
+                and doc["completedTimestamp"] < before
+            ):
+                due.append({**doc, "doc_id": doc.doc_id})
+        return due
+
+    def _summaries(self, download_ids: list[str]) -> dict[str, dict]:
+        return {
+            s["download_id"]: deepcopy(dict(s))
+            for s in self.summary_table.search(where("download_id").one_of(download_ids))
+        }
+
+    def _compact(self, due: list[dict], summaries: list[dict]):
+        # Every TinyDB write rewrites the whole file, so keep this to three
+        self.summary_table.remove(
+            where("download_id").one_of([s["download_id"] for s in summaries])
+        )
+        self.summary_table.insert_multiple(summaries)
+        self.db.remove(doc_ids=[r["doc_id"] for r in due])
+        for r in due:
+            self.doc_ids.pop((r["download_id"], r["item_id"]), None)
+
+    def _remove_summaries(self, before: float) -> int:
+        return len(self.summary_table.remove(where("completed") < before))
+
+
+class SQLiteTrackerStore(TrackerStore):
+    def __init__(self, path: str, **kwargs):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("PRAGMA busy_timeout=5000")
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS trackers (
+                download_id TEXT NOT NULL,
+                item_id TEXT NOT NULL,
+                type TEXT,
+                path TEXT,
+                container TEXT,
+                startedTimestamp REAL,
+                completedTimestamp REAL,
+                message TEXT,
+                PRIMARY KEY (download_id, item_id)
+            )"""
+        )
+        for column in ["download_id", "item_id", "type", "completedTimestamp"]:
+            self.db.execute(
+                f"CREATE INDEX IF NOT EXISTS trackers_{column} ON trackers ({column})"
+            )
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS tracker_summaries (
+                download_id TEXT PRIMARY KEY,
+                completed REAL,
+                data TEXT NOT NULL
+            )"""
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS tracker_summaries_completed ON tracker_summaries (completed)"
+        )
+        super().__init__(**kwargs)
+
+    def _row(self, row: tuple) -> dict:
+        record = dict(zip(TRACKER_FIELDS, row))
+        record["message"] = json.loads(record["message"])
+        return record
+
+    def _insert(self, records: list[dict]):
+        with self.db:
+            self.db.executemany(
+                f"INSERT OR REPLACE INTO trackers ({', '.join(TRACKER_FIELDS)}) VALUES ({', '.join('?' * len(TRACKER_FIELDS))})",
+                [
+                    [
+                        json.dumps(r[f]) if f == "message" else r[f]
+                        for f in TRACKER_FIELDS
+                    ]
+                    for r in records
+                ],
+            )
+
+    def _write_updates(self, updates: list[tuple[tuple[str, str], dict]]):
+        with self.db:
+            for (did, iid), fields in updates:
+                columns = [f for f in fields.keys() if f in TRACKER_FIELDS]
+                self.db.execute(
+                    f"UPDATE trackers SET {', '.join(c + ' = ?' for c in columns)} WHERE download_id = ? AND item_id = ?",
+                    [
+                        json.dumps(fields[c]) if c == "message" else fields[c]
+                        for c in columns
+                    ]
+                    + [did, iid],
+                )
+
+    def _select(self, download_id: str) -> list[dict]:
+        return [
+            self._row(r)
+            for r in self.db.execute(
+                f"SELECT {', '.join(TRACKER_FIELDS)} FROM trackers WHERE download_id = ? ORDER BY rowid",
+                [download_id],
+            )
+        ]
+
+    def _due(self, before: float) -> list[dict]:
+        # Range scan on the completedTimestamp index only touches expired rows
+        return [
+            self._row(r)
+            for r in self.db.execute(
+                f"SELECT {', '.join(TRACKER_FIELDS)} FROM trackers WHERE completedTimestamp < ? AND type IN ({', '.join('?' * len(FINISHED_TYPES))})",
+                [before] + FINISHED_TYPES,
+            )
+        ]
+
+    def _summaries(self, download_ids: list[str]) -> dict[str, dict]:
+        results = {}
+        for offset in range(0, len(download_ids), 500):
+            chunk = download_ids[offset : offset + 500]
+            for did, data in self.db.execute(
+                f"SELECT download_id, data FROM tracker_summaries WHERE download_id IN ({', '.join('?' * len(chunk))})",
+                chunk,
+            ):
+                results[did] = json.loads(data)
+        return results
+
+    def _compact(self, due: list[dict], summaries: list[dict]):
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO tracker_summaries (download_id, completed, data) VALUES (?, ?, ?)",
+                [(s["download_id"], s["completed"], json.dumps(s)) for s in summaries],
+            )
+            self.db.executemany(
+                "DELETE FROM trackers WHERE download_id = ? AND item_id = ?",
+                [(r["download_id"], r["item_id"]) for r in due],
+            )
+
+    def _remove_summaries(self, before: float) -> int:
+        with self.db:
+            return self.db.execute(
+                "DELETE FROM tracker_summaries WHERE completed < ?", [before]
+            ).rowcount
+
+
+TRACKER_BACKENDS = {"tinydb": TinyDBTrackerStore, "sqlite": SQLiteTrackerStore}
+
+
+def make_tracker_store(path: str, backend: str = "tinydb", **kwargs) -> TrackerStore:
+    if not backend in TRACKER_BACKENDS.keys():
+        raise ValueError(f"Unknown download tracker backend {backend}")
+    return TRACKER_BACKENDS[backend](path, **kwargs)